@@ -1,15 +1,14 @@
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, request, jsonify, send_file, render_template, Response, stream_with_context
 from flask_cors import CORS
-import requests
 import os
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 import json
-import PyPDF2
-import docx
-import chardet
 from datetime import datetime
 import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 import pandas as pd
 from openpyxl import load_workbook
 import re
@@ -25,6 +24,21 @@ import base64
 from matplotlib.font_manager import FontProperties
 import seaborn as sns
 from PIL import Image
+from llm_client import DashScopeClient, LLMError
+from llm_cache import LLMCache
+from resilience import AdaptiveLimiter, CircuitBreaker
+from prompt_budget import assemble_prompt
+from jobs import JobManager, QueueFullError
+from document_store import DocumentStore, SessionKnowledge
+from session_store import create_session_store, SessionLocks, SessionStoreError
+from bounded_state import BoundedState
+from document_summary import DocumentSummarizer
+from document_cache import DocumentCache, save_and_hash
+from pdf_extract import extract_pdf_text
+from text_decode import MAX_REPLACED_RATIO, UndecodableTextError, read_text_file
+from docx_extract import read_docx_text
+from chunked_upload import ChunkedFile, ChunkedUploadStore, UploadError
+from metrics import register_stats, render_metrics
 
 # 配置中文字体
 try:
@@ -54,9 +68,51 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
-# 阿里云大模型 API 配置
-API_KEY = "YOUR_API_KEY"
-API_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+# 阿里云大模型 API 配置（API_URL 可指向本地模拟服务 mock_dashscope.py）
+API_KEY = os.getenv('API_KEY', "YOUR_API_KEY")
+API_URL = os.getenv('API_URL', "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation")
+
+# 大模型响应缓存（内存LRU + SQLite磁盘缓存）
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+llm_cache = LLMCache(
+    db_path=os.path.join(CACHE_FOLDER, 'llm_cache.sqlite3'),
+    memory_max_entries=int(os.getenv('LLM_CACHE_MEMORY_ENTRIES', 256)),
+    disk_max_entries=int(os.getenv('LLM_CACHE_DISK_ENTRIES', 5000)),
+    ttl=int(os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600))
+)
+# 启用缓存的接口（对话接口温度较高，默认不缓存）
+LLM_CACHE_ENDPOINTS = {
+    name.strip() for name in os.getenv('LLM_CACHE_ENDPOINTS', 'excel_ai_process,data_analysis,document_summary').split(',') if name.strip()
+}
+
+# 已解析文档的文本缓存（按文件内容哈希，重复上传同一文件时跳过解析）
+document_cache = DocumentCache(
+    os.path.join(CACHE_FOLDER, 'documents'),
+    max_bytes=int(os.getenv('DOCUMENT_CACHE_MAX_MB', 512)) * 1024 * 1024
+)
+
+# 共享的大模型客户端（连接池大小和超时可通过环境变量调整）
+llm = DashScopeClient(
+    API_KEY,
+    API_URL,
+    pool_size=int(os.getenv('LLM_POOL_SIZE', 10)),
+    connect_timeout=float(os.getenv('LLM_CONNECT_TIMEOUT', 5)),
+    read_timeout=float(os.getenv('LLM_READ_TIMEOUT', 120)),
+    cache=llm_cache,
+    # 根据延迟和429/5xx自适应调整并发（AIMD），上游持续失败时熔断快速失败
+    limiter=AdaptiveLimiter(
+        initial_limit=int(os.getenv('LLM_CONCURRENCY_INITIAL', 8)),
+        min_limit=int(os.getenv('LLM_CONCURRENCY_MIN', 1)),
+        max_limit=int(os.getenv('LLM_CONCURRENCY_MAX', os.getenv('LLM_POOL_SIZE', 10))),
+        latency_target=float(os.getenv('LLM_LATENCY_TARGET', 45))
+    ),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv('LLM_BREAKER_FAILURES', 5)),
+        recovery_timeout=float(os.getenv('LLM_BREAKER_RECOVERY', 30))
+    ),
+    max_retries=int(os.getenv('LLM_MAX_RETRIES', 2)),
+    queue_timeout=float(os.getenv('LLM_QUEUE_TIMEOUT', 30))
+)
 
 # 文件上传配置
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
@@ -74,48 +130,160 @@ ANALYSIS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'anal
 if not os.path.exists(ANALYSIS_FOLDER):
     os.makedirs(ANALYSIS_FOLDER)
 
+# 数据分析中相互独立的大模型调用共用的有界线程池
+analysis_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('ANALYSIS_MAX_WORKERS', 4)),
+    thread_name_prefix='analysis'
+)
+
+# 异步数据分析任务：有界工作线程、排队深度和保留的已结束任务数（结果含图片，占用较大）
+analysis_jobs = JobManager(
+    max_workers=int(os.getenv('ANALYSIS_JOB_WORKERS', 2)),
+    queue_depth=int(os.getenv('ANALYSIS_JOB_QUEUE_DEPTH', 8)),
+    max_finished=int(os.getenv('ANALYSIS_JOB_MAX_FINISHED', 50)),
+    name='analysis-job'
+)
+
+# 知识库文档后台解析入库：有界工作线程、排队深度和保留的已结束任务数
+ingestion_jobs = JobManager(
+    max_workers=int(os.getenv('INGESTION_WORKERS', 2)),
+    queue_depth=int(os.getenv('INGESTION_QUEUE_DEPTH', 16)),
+    max_finished=int(os.getenv('INGESTION_MAX_FINISHED', 200)),
+    name='ingestion'
+)
+
+# 缓存、请求合并和分析任务队列的运行统计，在 /metrics 抓取时采集
+register_stats('llm_cache', '大模型响应缓存统计', llm_cache.stats)
+register_stats('llm_coalescing', '相同请求合并统计', llm.singleflight.stats)
+register_stats('llm_limiter', '大模型自适应并发限制', llm.limiter.stats)
+register_stats('llm_breaker', '大模型熔断器', llm.breaker.stats)
+register_stats('document_cache', '已解析文档文本缓存统计', document_cache.stats)
+register_stats('analysis_jobs', '分析任务队列统计', lambda: {
+    f"{status}_count": count for status, count in analysis_jobs.stats()['jobs'].items()
+})
+register_stats('ingestion_jobs', '文档解析入库任务统计', lambda: {
+    f"{status}_count": count for status, count in ingestion_jobs.stats()['jobs'].items()
+})
+
+# matplotlib 的全局绘图状态非线程安全，绘图时需持有该锁
+plot_lock = threading.Lock()
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# 存储知识库内容和初始prompt
-knowledge_base = {}
-initial_prompt = {}
-# 存储会话数据
-sessions = {}
+# 超过单次请求大小限制的文件使用分片上传（分片大小需小于 MAX_CONTENT_LENGTH）
+chunked_uploads = ChunkedUploadStore(
+    os.path.join(UPLOAD_FOLDER, 'chunked'),
+    max_size=int(os.getenv('CHUNKED_UPLOAD_MAX_MB', 1024)) * 1024 * 1024,
+    chunk_size=int(os.getenv('CHUNKED_UPLOAD_CHUNK_MB', 8)) * 1024 * 1024,
+    ttl=int(os.getenv('CHUNKED_UPLOAD_TTL', 24 * 3600))
+)
+
+# 对话提示词的token预算和最多保留的历史消息条数
+CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv('CHAT_PROMPT_TOKEN_BUDGET', 6000))
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv('CHAT_HISTORY_MAX_MESSAGES', 20))
+
+# 知识库检索方式（bm25 / vector）、文本块大小（字符）和每轮对话检索的文本块数
+KNOWLEDGE_RETRIEVAL = os.getenv('KNOWLEDGE_RETRIEVAL', 'bm25')
+KNOWLEDGE_CHUNK_SIZE = int(os.getenv('KNOWLEDGE_CHUNK_SIZE', 500))
+KNOWLEDGE_TOP_K = int(os.getenv('KNOWLEDGE_TOP_K', 5))
+
+# PDF 分页并行提取的进程数、单页超时 (秒) 和启用并行的最少页数
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_PAGE_TIMEOUT = float(os.getenv('PDF_PAGE_TIMEOUT', 10))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 16))
+
+# 大文档入库时可选的 map-reduce 摘要：超过 DOCUMENT_SUMMARY_MIN_CHARS 字符的文档分节并发生成摘要
+DOCUMENT_SUMMARY_ENABLED = os.getenv('DOCUMENT_SUMMARY_ENABLED', 'false').lower() == 'true'
+DOCUMENT_SUMMARY_MIN_CHARS = int(os.getenv('DOCUMENT_SUMMARY_MIN_CHARS', 20000))
+summary_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('DOCUMENT_SUMMARY_MAX_WORKERS', 4)),
+    thread_name_prefix='summary'
+)
+document_summarizer = DocumentSummarizer(
+    llm,
+    summary_executor,
+    section_chars=int(os.getenv('DOCUMENT_SUMMARY_SECTION_CHARS', 6000)),
+    use_cache='document_summary' in LLM_CACHE_ENDPOINTS
+)
+
+# 所有会话共享的文档存储：相同内容的文档只索引和保存一份
+document_store = DocumentStore(KNOWLEDGE_RETRIEVAL, KNOWLEDGE_CHUNK_SIZE)
+register_stats('document_store', '共享文档存储统计', document_store.stats)
+
+# 进程内会话状态的空闲过期时间 (秒)
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', 24 * 3600))
+
+# 会话、消息、初始prompt和知识库文档引用保存在会话存储中：
+# sqlite 为 WAL 模式的持久化存储，多个 worker 进程可共享；memory 为进程内存储，用于测试，
+# 会话数和估算的内存占用超过上限时按最近最少使用淘汰
+session_store = create_session_store(
+    os.getenv('SESSION_STORE', 'sqlite'),
+    os.getenv('SESSION_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'sessions.db')),
+    flush_interval=int(os.getenv('SESSION_WRITE_BATCH_MS', 20)) / 1000,
+    max_sessions=int(os.getenv('SESSION_MEMORY_MAX_SESSIONS', 1000)),
+    max_bytes=int(os.getenv('SESSION_MEMORY_MAX_MB', 128)) * 1024 * 1024,
+    idle_ttl=SESSION_IDLE_TTL,
+    write_timeout=float(os.getenv('SESSION_WRITE_TIMEOUT', 30))
+)
+register_stats('session_store', '会话存储统计', session_store.stats)
+# 同一会话的对话轮次依次执行：读取历史、调用大模型和保存回复期间持有会话写锁，
+# 等待超过 SESSION_LOCK_TIMEOUT 秒时返回 409
+session_locks = SessionLocks()
+SESSION_LOCK_TIMEOUT = float(os.getenv('SESSION_LOCK_TIMEOUT', 120))
+register_stats('session_locks', '会话写锁', session_locks.stats)
+# 临时会话的 prompt 和知识库迁移到正式会话、以及入库任务写入知识库引用时持有该锁
+temp_migration_lock = threading.Lock()
+
+# 会话列表每页的默认和最大条数
+SESSION_PAGE_SIZE = int(os.getenv('SESSION_PAGE_SIZE', 50))
+SESSION_PAGE_MAX = 200
+
+# 本进程中各会话的知识库：对共享文档的引用，与会话存储中的引用列表同步。
+# 按会话数、引用文档的文本量和空闲时间限制，淘汰时释放文档引用，
+# 引用列表仍在会话存储中，再次访问时从文档文本缓存重新加载
+knowledge_base = BoundedState(
+    max_entries=int(os.getenv('KNOWLEDGE_BASE_MAX_SESSIONS', 200)),
+    max_bytes=int(os.getenv('KNOWLEDGE_BASE_MAX_MB', 256)) * 1024 * 1024,
+    idle_ttl=int(os.getenv('KNOWLEDGE_BASE_IDLE_TTL', 2 * 3600)),
+    sizeof=lambda knowledge: knowledge.content_chars(),
+    on_evict=lambda session_id, knowledge: knowledge.close()
+)
+register_stats('knowledge_base', '进程内会话知识库占用', knowledge_base.stats)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def detect_encoding(filepath):
-    """检测文件编码"""
-    with open(filepath, 'rb') as f:
-        raw_data = f.read(10000)  # 读取前10000字节来检测编码
-        result = chardet.detect(raw_data)
-        return result['encoding']
+def get_request_file():
+    """获取请求中的上传文件：表单的 file 字段，或通过 upload_id 引用的已完成分片上传的文件"""
+    upload_id = request.form.get('upload_id')
+    if upload_id:
+        return chunked_uploads.get_completed(upload_id)
+    return request.files.get('file')
+
+@app.errorhandler(UploadError)
+def handle_upload_error(e):
+    return jsonify({'error': str(e)}), e.status_code
 
 def read_pdf_content(filepath):
-    """读取PDF文件内容"""
+    """读取PDF文件内容（页数较多时在进程池中分页并行提取）"""
     try:
-        content = []
-        with open(filepath, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            num_pages = len(pdf_reader.pages)
-            for page_num in range(num_pages):
-                page = pdf_reader.pages[page_num]
-                content.append(page.extract_text())
-        return '\n'.join(content)
+        content, stats = extract_pdf_text(
+            filepath,
+            workers=PDF_EXTRACT_WORKERS,
+            page_timeout=PDF_PAGE_TIMEOUT,
+            parallel_min_pages=PDF_PARALLEL_MIN_PAGES
+        )
+        print(f"PDF提取完成: {stats['pages']}页, 耗时{stats['seconds']}秒, {stats['pages_per_second']}页/秒"
+              + (f", {stats['timed_out_pages']}页超时" if stats['timed_out_pages'] else ''))
+        return content
     except Exception as e:
         return f"PDF读取错误: {str(e)}"
 
 def read_docx_content(filepath):
-    """读取DOCX文件内容"""
+    """读取DOCX文件内容（流式解析，包含表格）"""
     try:
-        doc = docx.Document(filepath)
-        content = []
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                content.append(paragraph.text)
-        return '\n'.join(content)
+        return read_docx_text(filepath)
     except Exception as e:
         return f"DOCX读取错误: {str(e)}"
 
@@ -134,23 +302,18 @@ def read_file_content(filepath):
             # DOC格式较复杂，建议转换为DOCX
             return "DOC格式文件暂不支持，请转换为DOCX格式后上传"
         else:
-            # 文本文件：尝试检测编码
-            encoding = detect_encoding(filepath)
-            if not encoding:
-                encoding = 'utf-8'
-            
+            # 文本文件：增量检测编码后流式解码
+            stats = {}
             try:
-                with open(filepath, 'r', encoding=encoding) as f:
-                    return f.read()
-            except:
-                # 如果检测的编码失败，尝试常用编码
-                for enc in ['utf-8', 'gbk', 'gb2312', 'utf-16', 'big5']:
-                    try:
-                        with open(filepath, 'r', encoding=enc) as f:
-                            return f.read()
-                    except:
-                        continue
-                return "无法读取文件内容：编码格式不支持"
+                content = read_text_file(filepath, stats=stats)
+            except UndecodableTextError as e:
+                return str(e)
+            if stats['replaced_chars']:
+                # 没有编码能完整解码文件，少量无法解码的字节已替换为 U+FFFD
+                print(f"文件 {filepath} 按 {stats['encoding']} 解码时替换了 {stats['replaced_chars']} 个无法解码的字符")
+                if stats['replaced_chars'] > len(content) * MAX_REPLACED_RATIO:
+                    return f"文件读取错误: 无法识别文件编码，{stats['replaced_chars']} 个字符无法解码"
+            return content
     except Exception as e:
         return f"文件读取错误: {str(e)}"
 
@@ -158,22 +321,146 @@ def create_session(mode='normal', title=None):
     """创建新会话"""
     session_id = str(uuid.uuid4())
     now = datetime.now()
-    sessions[session_id] = {
+    session = {
         'id': session_id,
         'mode': mode,
         'title': title or f"新对话",
         'messages': [],
+        'message_count': 0,
         'created_at': now.isoformat(),
         'updated_at': now.isoformat()
     }
-    return sessions[session_id]
+    session_store.create_session(session)
+    return session
 
-def update_session_title(session_id, first_message):
+def update_session_title(session, first_message):
     """根据第一条消息更新会话标题"""
-    if session_id in sessions and sessions[session_id]['title'].startswith("新对话"):
+    if session['title'].startswith("新对话"):
         # 截取前30个字符作为标题
         title = first_message[:30] + "..." if len(first_message) > 30 else first_message
-        sessions[session_id]['title'] = title
+        session['title'] = title
+        session_store.update_session(session['id'], title=title)
+
+def lock_chat_session(session_id, mode):
+    """获取对话会话并持有它的写锁，返回 (session, lock)；等待超时返回 (None, None)
+
+    持有锁后才读取历史（只加载构造提示词所需的最近消息），同一会话上一轮的回复一定已保存。
+    会话不存在或为新会话时创建，并迁移临时设置。调用方保存本轮对话后调用 lock.release()。
+    """
+    if session_id != 'new':
+        lock = session_locks.acquire(session_id, timeout=SESSION_LOCK_TIMEOUT)
+        if lock is None:
+            return None, None
+        session = session_store.get_session(session_id, message_limit=CHAT_HISTORY_MAX_MESSAGES)
+        if session is not None:
+            return session, lock
+        lock.release()
+    
+    session = create_session(mode)
+    session_id = session['id']
+    lock = session_locks.acquire(session_id)
+    
+    # 迁移临时设置到新会话：会话存储和本进程的知识库一起迁移
+    with temp_migration_lock:
+        session_store.move_temp(session_id)
+        knowledge = knowledge_base.pop('temp')
+        if knowledge is not None:
+            knowledge.session_id = session_id
+            knowledge_base.set(session_id, knowledge)
+    return session, lock
+
+def load_knowledge_document(document_key):
+    """重新加载其他进程入库或已从本进程释放的文档，返回已取得引用的文档信息
+
+    优先使用会话存储中随引用保存的文本，其次是文档文本缓存；都没有时返回 None，
+    由调用方在对话结果中报告缺失的文档。
+    """
+    digest, file_extension = document_key.split('.', 1)
+    stored = session_store.get_document(document_key) or {}
+    content = stored.get('content') or document_cache.get(digest, file_extension)
+    if content is None:
+        print(f"知识库文档 {document_key} 的文本已不存在，无法加载")
+        return None
+    document = document_store.add(document_key, content)
+    summary = stored.get('digest') or document_cache.get(digest, f"{file_extension}.digest")
+    if summary:
+        document_store.set_digest(document_key, summary)
+    return document
+
+def get_session_knowledge(session_id, create=False):
+    """获取会话在本进程中的知识库，并与会话存储中的文档引用同步；没有文档且 create 为 False 时返回 None"""
+    refs = session_store.get_knowledge_refs(session_id)
+    knowledge = knowledge_base.get(session_id)
+    if knowledge is None:
+        if not refs and not create:
+            return None
+        knowledge = knowledge_base.setdefault(session_id, lambda: SessionKnowledge(document_store, session_id))
+    knowledge.sync(refs, load_knowledge_document)
+    knowledge_base.resize(session_id)
+    return knowledge
+
+def drop_session_knowledge(session_id):
+    """释放会话在本进程中的知识库"""
+    knowledge = knowledge_base.pop(session_id)
+    if knowledge is not None:
+        knowledge.close()
+
+def build_chat_messages(session, mode, user_message):
+    """在token预算内构造发送给大模型的消息列表，返回 (messages, report)"""
+    session_id = session['id']
+    system_prompt = None
+    knowledge = None
+    
+    # 根据模式确定系统消息
+    knowledge_refs = get_session_knowledge(session_id) if mode == 'knowledge' else None
+    if mode == 'normal':
+        # 普通模式，使用初始prompt
+        system_prompt = session_store.get_prompt(session_id)
+    elif knowledge_refs is not None:
+        # 知识库模式，检索与问题最相关的文本块作为上下文
+        system_prompt = "你是一个智能助手。请基于以下知识库内容回答用户的问题。如果问题与知识库内容相关，请优先使用知识库中的信息进行回答。"
+        digests = [f"文件：{filename}\n摘要：{digest}" for filename, digest in knowledge_refs.digests()]
+        chunks = knowledge_refs.search(user_message, KNOWLEDGE_TOP_K)
+        if chunks:
+            # 检索到的文本块优先，其次是文档摘要
+            knowledge = [f"文件：{chunk['source']}\n内容：{chunk['text']}" for chunk in chunks] + digests
+        else:
+            # 问题与任何文本块都不匹配（如“总结一下”）时，以文档摘要为主
+            chunks = knowledge_refs.leading_chunks(KNOWLEDGE_TOP_K)
+            knowledge = digests + [f"文件：{chunk['source']}\n内容：{chunk['text']}" for chunk in chunks]
+    
+    # 历史消息最多保留最近10轮对话，再按预算从新到旧裁剪
+    history_messages = session['messages'][-CHAT_HISTORY_MAX_MESSAGES:]
+    messages, report = assemble_prompt(
+        system_prompt,
+        history_messages,
+        user_message,
+        knowledge=knowledge,
+        budget=CHAT_PROMPT_TOKEN_BUDGET
+    )
+    if knowledge_refs is not None and knowledge_refs.missing:
+        # 引用的文档文本已丢失时告知调用方，而不是静默地少用这些文档回答
+        report['missing_documents'] = knowledge_refs.missing
+        print(f"会话 {session_id} 有 {len(knowledge_refs.missing)} 个知识库文档无法加载: {knowledge_refs.missing}")
+    if report['history_dropped'] or report['knowledge_dropped'] or report['knowledge_truncated']:
+        print(f"会话 {session_id} 提示词超出预算，已裁剪: {report}")
+    return messages, report
+
+def save_chat_turn(session, user_message, ai_reply):
+    """保存一轮对话到会话历史，两条消息在同一事务中写入"""
+    messages = [
+        {
+            'role': 'user',
+            'content': user_message,
+            'timestamp': datetime.now().isoformat()
+        },
+        {
+            'role': 'assistant',
+            'content': ai_reply,
+            'timestamp': datetime.now().isoformat()
+        }
+    ]
+    session_store.append_messages(session['id'], messages, datetime.now().isoformat())
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
@@ -188,127 +475,197 @@ def chat():
             return jsonify({'error': '消息不能为空'}), 400
         
         # 如果会话不存在或者是新会话，创建新会话
-        if session_id == 'new' or session_id not in sessions:
-            session = create_session(mode)
+        session, session_lock = lock_chat_session(session_id, mode)
+        if session is None:
+            return jsonify({'error': '该会话正在回复中，请稍后重试'}), 409
+        try:
             session_id = session['id']
             
-            # 迁移临时设置到新会话
-            if 'temp' in initial_prompt:
-                initial_prompt[session_id] = initial_prompt['temp']
-                del initial_prompt['temp']
-            if 'temp' in knowledge_base:
-                knowledge_base[session_id] = knowledge_base['temp']
-                del knowledge_base['temp']
-        else:
-            session = sessions[session_id]
-        
-        # 如果是第一条消息，更新标题
-        if len(session['messages']) == 0:
-            update_session_title(session_id, user_message)
-        
-        # 构造请求头
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY}"
-        }
-        
-        # 构造消息列表
-        messages = []
-        
-        # 根据模式添加系统消息
-        if mode == 'normal' and session_id in initial_prompt:
-            # 普通模式，使用初始prompt
-            messages.append({
-                "role": "system",
-                "content": initial_prompt[session_id]
-            })
-        elif mode == 'knowledge' and session_id in knowledge_base:
-            # 知识库模式，将知识库内容作为上下文
-            kb_content = "\n\n".join(knowledge_base[session_id])
-            system_message = f"你是一个智能助手。请基于以下知识库内容回答用户的问题。如果问题与知识库内容相关，请优先使用知识库中的信息进行回答。\n\n知识库内容：\n{kb_content}"
-            messages.append({
-                "role": "system",
-                "content": system_message
-            })
-        
-        # 添加历史消息（最多保留最近10轮对话）
-        history_messages = session['messages'][-20:] if len(session['messages']) > 20 else session['messages']
-        for msg in history_messages:
-            messages.append({
-                "role": msg['role'],
-                "content": msg['content']
-            })
+            # 如果是第一条消息，更新标题
+            if session['message_count'] == 0:
+                update_session_title(session, user_message)
+            
+            # 构造消息列表
+            messages, prompt_report = build_chat_messages(session, mode, user_message)
+            
+            # 调用阿里云大模型 API；生成回复本身没有副作用（对话在成功后才写入会话），可以重试
+            try:
+                ai_reply = llm.generate(messages, temperature=0.7, max_tokens=1000, endpoint='chat', idempotent=True, use_cache='chat' in LLM_CACHE_ENDPOINTS) or '抱歉，我无法回答这个问题。'
+            except LLMError as e:
+                print(f"对话接口调用大模型失败: {str(e)}")
+                if e.unavailable:
+                    return jsonify({'error': '服务繁忙，请稍后重试'}), 503
+                return jsonify({'error': 'API 调用失败'}), 500
+            
+            # 保存消息到会话历史，保存失败时不返回回复，避免客户端以为这一轮已记录
+            try:
+                save_chat_turn(session, user_message, ai_reply)
+            except SessionStoreError as e:
+                print(f"保存对话失败: {str(e)}")
+                return jsonify({'error': '保存对话失败，请重试'}), 500
+        finally:
+            session_lock.release()
         
-        # 添加用户消息
-        messages.append({
-            "role": "user",
-            "content": user_message
+        return jsonify({
+            'reply': ai_reply,
+            'session_id': session_id,
+            'prompt_report': prompt_report
         })
+            
+    except Exception as e:
+        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+
+def sse_event(data, event=None):
+    """格式化一条 Server-Sent Events 消息"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """流式对话接口，通过 SSE 逐段返回模型回复"""
+    try:
+        data = request.get_json()
+        user_message = data.get('message', '')
+        mode = data.get('mode', 'normal')
+        session_id = data.get('session_id', 'default')
         
-        # 构造请求体
-        payload = {
-            "model": "qwen-max",
-            "input": {
-                "messages": messages
-            },
-            "parameters": {
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
-        }
+        if not user_message:
+            return jsonify({'error': '消息不能为空'}), 400
         
-        # 调用阿里云大模型 API
-        response = requests.post(API_URL, headers=headers, json=payload)
+        session, session_lock = lock_chat_session(session_id, mode)
+        if session is None:
+            return jsonify({'error': '该会话正在回复中，请稍后重试'}), 409
+    except Exception as e:
+        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+    
+    try:
+        session_id = session['id']
         
-        if response.status_code == 200:
-            result = response.json()
-            # 提取 AI 回复内容
-            ai_reply = result.get('output', {}).get('text', '抱歉，我无法回答这个问题。')
-            
-            # 保存消息到会话历史
-            session['messages'].append({
-                'role': 'user',
-                'content': user_message,
-                'timestamp': datetime.now().isoformat()
-            })
-            session['messages'].append({
-                'role': 'assistant',
-                'content': ai_reply,
-                'timestamp': datetime.now().isoformat()
-            })
-            session['updated_at'] = datetime.now().isoformat()
+        if session['message_count'] == 0:
+            update_session_title(session, user_message)
+        
+        messages, prompt_report = build_chat_messages(session, mode, user_message)
+    except Exception as e:
+        session_lock.release()
+        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+    
+    def generate():
+        try:
+            # 先告知前端会话ID，便于新会话立即切换
+            yield sse_event({'session_id': session_id, 'prompt_report': prompt_report}, event='session')
             
-            return jsonify({
-                'reply': ai_reply,
-                'session_id': session_id
-            })
-        else:
-            return jsonify({'error': 'API 调用失败'}), 500
+            reply_parts = []
+            try:
+                # 只在开始输出前重试，对话在完整输出后才写入会话
+                for delta in llm.stream(messages, temperature=0.7, max_tokens=1000, endpoint='chat_stream', idempotent=True):
+                    reply_parts.append(delta)
+                    yield sse_event({'delta': delta})
+            except LLMError as e:
+                print(f"流式对话调用大模型失败: {str(e)}")
+                yield sse_event({'error': '服务繁忙，请稍后重试' if e.unavailable else 'API 调用失败'}, event='error')
+                return
             
+            # 流结束后再提交会话历史
+            ai_reply = ''.join(reply_parts) or '抱歉，我无法回答这个问题。'
+            try:
+                save_chat_turn(session, user_message, ai_reply)
+            except SessionStoreError as e:
+                print(f"保存对话失败: {str(e)}")
+                yield sse_event({'error': '保存对话失败，请重试'}, event='error')
+                return
+            yield sse_event({'reply': ai_reply, 'session_id': session_id}, event='done')
+        finally:
+            session_lock.release()
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # 客户端在流开始前断开时生成器不会执行，关闭响应时也释放会话锁
+    response.call_on_close(session_lock.release)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 指标接口"""
+    content, content_type = render_metrics()
+    return Response(content, mimetype=content_type)
+
+@app.route('/api/llm_cache/stats', methods=['GET'])
+def get_llm_cache_stats():
+    """获取大模型响应缓存的命中统计"""
+    try:
+        return jsonify(llm_cache.stats())
     except Exception as e:
-        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+        return jsonify({'error': f'获取缓存统计失败: {str(e)}'}), 500
+
+@app.route('/api/llm_coalescing/stats', methods=['GET'])
+def get_llm_coalescing_stats():
+    """获取相同请求合并的统计（被合并的调用次数等）"""
+    try:
+        return jsonify(llm.singleflight.stats())
+    except Exception as e:
+        return jsonify({'error': f'获取合并统计失败: {str(e)}'}), 500
 
 @app.route('/api/sessions', methods=['GET'])
 def get_sessions():
-    """获取所有会话列表"""
+    """获取会话列表：只返回有消息的会话摘要，按更新时间倒序，通过 cursor 分页"""
     try:
-        # 只返回有消息的会话，按更新时间倒序排列
-        session_list = [s for s in sessions.values() if len(s['messages']) > 0]
-        session_list = sorted(session_list, 
-                            key=lambda x: x['updated_at'], 
-                            reverse=True)
-        return jsonify(session_list)
+        limit = min(max(request.args.get('limit', SESSION_PAGE_SIZE, type=int), 1), SESSION_PAGE_MAX)
+        try:
+            summaries, next_cursor = session_store.list_sessions(limit, request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'sessions': summaries, 'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'error': f'获取会话列表失败: {str(e)}'}), 500
 
+def session_etag(session):
+    """会话的 ETag：消息数和标题、模式、更新时间任一变化都会改变"""
+    version = f"{session['updated_at']}|{session['title']}|{session['mode']}"
+    return f"{session['message_count']}-{hashlib.sha1(version.encode('utf-8')).hexdigest()[:16]}"
+
 @app.route('/api/sessions/<session_id>', methods=['GET'])
 def get_session(session_id):
-    """获取特定会话的详情"""
+    """获取特定会话的详情
+
+    支持 If-None-Match：会话未变化时返回 304。
+    since 为消息序号或 ISO 时间戳时只返回之后的新消息，响应中的 since 为第一条返回消息的序号；
+    带时区的时间戳按本地时间比较。
+    """
     try:
-        if session_id in sessions:
-            return jsonify(sessions[session_id])
-        else:
+        session = session_store.get_session(session_id, message_limit=0)
+        if session is None:
             return jsonify({'error': '会话不存在'}), 404
+        
+        since = request.args.get('since')
+        etag = session_etag(session)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            if since is None:
+                session['messages'] = session_store.get_messages(session_id)
+            elif since.isdigit():
+                session['since'] = min(int(since), session['message_count'])
+                session['messages'] = session_store.get_messages(session_id, start=session['since'])
+            else:
+                try:
+                    # 兼容 Z 结尾的 UTC 时间（Python 3.11 之前的 fromisoformat 不支持）
+                    after = datetime.fromisoformat(since[:-1] + '+00:00' if since.endswith('Z') else since)
+                except ValueError:
+                    return jsonify({'error': 'since 应为消息序号或 ISO 时间戳'}), 400
+                if after.tzinfo is not None:
+                    # 消息时间戳是不带时区的本地时间，带时区的 since 先换算为本地时间再按字符串比较
+                    after = after.astimezone().replace(tzinfo=None)
+                after = after.isoformat()
+                session['messages'] = session_store.get_messages(session_id, after=after)
+                session['since'] = session['message_count'] - len(session['messages'])
+            response = jsonify(session)
+        response.set_etag(etag)
+        # 浏览器每次都带 If-None-Match 重新验证
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         return jsonify({'error': f'获取会话失败: {str(e)}'}), 500
 
@@ -316,13 +673,9 @@ def get_session(session_id):
 def delete_session(session_id):
     """删除会话"""
     try:
-        if session_id in sessions:
-            del sessions[session_id]
-            # 同时删除相关的知识库和prompt
-            if session_id in knowledge_base:
-                del knowledge_base[session_id]
-            if session_id in initial_prompt:
-                del initial_prompt[session_id]
+        # 会话存储同时删除消息、prompt和知识库引用
+        if session_store.delete_session(session_id):
+            drop_session_knowledge(session_id)
             return jsonify({'success': True})
         else:
             return jsonify({'error': '会话不存在'}), 404
@@ -341,49 +694,168 @@ def new_session():
     except Exception as e:
         return jsonify({'error': f'创建会话失败: {str(e)}'}), 500
 
+# 文档入库的阶段
+INGESTION_STAGES = ['解析文本', '分块索引'] + (['生成摘要'] if DOCUMENT_SUMMARY_ENABLED else [])
+
+def summarize_document(progress, document_key, filename, content, digest, file_extension):
+    """为大文档生成摘要并保存到共享存储，摘要与提取的文本一起缓存；失败时不影响入库"""
+    progress('生成摘要')
+    digest_kind = f"{file_extension}.digest"
+    summary = document_cache.get(digest, digest_kind)
+    if summary is None:
+        if content is None:
+            content = document_cache.get(digest, file_extension)
+        if content is None:
+            return False
+        try:
+            summary = document_summarizer.summarize(content, filename, progress=lambda message: progress('生成摘要', message))
+        except LLMError as e:
+            print(f"文档 {filename} 生成摘要失败: {str(e)}")
+            return False
+        document_cache.set(digest, digest_kind, summary)
+    document_store.set_digest(document_key, summary)
+    session_store.set_document_digest(document_key, summary)
+    return True
+
+def ingest_document(progress, knowledge, filename, filepath, digest, file_extension):
+    """后台任务：解析文档文本（优先使用缓存）、分块并加入知识库，结束后删除上传文件
+
+    相同内容的文档已在共享存储中时直接引用，不再解析和索引。
+    """
+    try:
+        progress('解析文本')
+        document_key = f"{digest}.{file_extension}"
+        content = None
+        document = document_store.acquire(document_key)
+        cached = document is not None
+        if document is None:
+            content = document_cache.get(digest, file_extension)
+            cached = content is not None
+            if not cached:
+                content = read_file_content(filepath)
+                # 检查内容是否读取成功
+                if "错误" in content or "不支持" in content:
+                    raise ValueError(f'文件读取失败: {content}')
+                document_cache.set(digest, file_extension, content)
+            
+            # 完整内容分块后加入知识库检索索引，加入后即可在对话中检索到
+            progress('分块索引', f'{len(content)}字符')
+            document = document_store.add(document_key, content)
+        
+        # 先持久化引用和文档文本再加入本进程的知识库，其他进程同步引用列表时即可加载，
+        # 文本缓存淘汰或重启后也不会丢失；
+        # 持有迁移锁，避免临时会话迁移到一半时把引用写到已迁移走的临时会话
+        if content is None:
+            content = document_cache.get(digest, file_extension)
+        with temp_migration_lock:
+            session_store.add_knowledge_ref(knowledge.session_id, document_key, filename, content)
+            knowledge.attach(document_key, filename)
+        knowledge_base.resize(knowledge.session_id)
+        
+        summarized = bool(document_store.get_digest(document_key))
+        if (DOCUMENT_SUMMARY_ENABLED and not summarized
+                and document['content_length'] >= DOCUMENT_SUMMARY_MIN_CHARS):
+            summarized = summarize_document(progress, document_key, filename, content, digest, file_extension)
+        return {
+            'filename': filename,
+            'content_length': document['content_length'],
+            'chunk_count': document['chunk_count'],
+            'cached': cached,
+            'summarized': summarized
+        }
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    """处理文件上传"""
+    """处理文件上传：保存文件后立即返回入库任务ID，解析和索引在后台进行"""
     try:
         session_id = request.form.get('session_id', 'default')
         
-        if 'file' not in request.files:
+        file = get_request_file()
+        if file is None:
             return jsonify({'error': '没有文件'}), 400
         
-        file = request.files['file']
         if file.filename == '':
             return jsonify({'error': '没有选择文件'}), 400
         
         if file and allowed_file(file.filename):
+            file_extension = file.filename.rsplit('.', 1)[1].lower()
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_{filename}")
-            file.save(filepath)
-            
-            # 读取文件内容并添加到知识库
-            content = read_file_content(filepath)
-            if session_id not in knowledge_base:
-                knowledge_base[session_id] = []
+            if not filename.lower().endswith('.' + file_extension):
+                # secure_filename 会去掉中文字符，可能连扩展名一起丢失
+                filename = f"{filename or 'file'}.{file_extension}"
+            # 加上随机前缀，避免同名文件同时入库时互相覆盖
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_{uuid.uuid4().hex[:8]}_{filename}")
+            if isinstance(file, ChunkedFile):
+                # 分片上传的文件完成时已计算哈希，直接移动过来
+                digest = file.sha256
+                file.save(filepath)
+            else:
+                # 保存文件的同时计算内容哈希
+                digest, _ = save_and_hash(file.stream, filepath)
             
-            # 检查内容是否读取成功
-            if "错误" in content or "不支持" in content:
-                # 删除临时文件
+            # 先取得会话的知识库再提交任务，临时会话迁移到正式会话后文档仍会加入同一知识库
+            knowledge = get_session_knowledge(session_id, create=True)
+            try:
+                ingestion_id = ingestion_jobs.submit(
+                    ingest_document, knowledge, filename, filepath, digest, file_extension,
+                    stages=INGESTION_STAGES
+                )
+            except QueueFullError as e:
                 os.remove(filepath)
-                return jsonify({'error': f'文件读取失败: {content}'}), 400
-            
-            # 添加到知识库，包含文件信息和内容长度
-            file_info = f"文件：{filename}\n内容长度：{len(content)}字符\n内容：{content[:500]}..." if len(content) > 500 else f"文件：{filename}\n内容：{content}"
-            knowledge_base[session_id].append(file_info)
+                return jsonify({'error': str(e)}), 503
             
-            # 删除临时文件
-            os.remove(filepath)
-            
-            return jsonify({'success': True, 'filename': filename, 'content_length': len(content)})
+            return jsonify({'success': True, 'ingestion_id': ingestion_id, 'filename': filename, 'status': 'queued'}), 202
         else:
             return jsonify({'error': '不支持的文件类型'}), 400
             
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
     except Exception as e:
         return jsonify({'error': f'上传失败: {str(e)}'}), 500
 
+@app.route('/api/upload/<ingestion_id>', methods=['GET'])
+def get_upload_status(ingestion_id):
+    """获取文档入库进度，完成后返回内容长度和文本块数"""
+    job = ingestion_jobs.get(ingestion_id, include_result=True)
+    if job is None:
+        return jsonify({'error': '入库任务不存在'}), 404
+    return jsonify(job)
+
+@app.route('/api/chunked_uploads', methods=['POST'])
+def init_chunked_upload():
+    """创建分片上传任务，请求体为 {filename, size, sha256(可选)}"""
+    data = request.get_json() or {}
+    upload = chunked_uploads.init(data.get('filename', ''), data.get('size'), data.get('sha256'))
+    return jsonify(upload), 201
+
+@app.route('/api/chunked_uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """查询已接收的字节数，用于断点续传"""
+    return jsonify(chunked_uploads.status(upload_id))
+
+@app.route('/api/chunked_uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """上传一个分片：请求体为分片内容，offset 为分片在文件中的起始位置，X-Chunk-SHA256 头可选"""
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': '缺少 offset 参数'}), 400
+    upload = chunked_uploads.write_chunk(upload_id, offset, request.stream, request.headers.get('X-Chunk-SHA256'))
+    return jsonify(upload)
+
+@app.route('/api/chunked_uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """校验并完成分片上传，之后可在各上传接口中以 upload_id 代替 file 字段"""
+    return jsonify(chunked_uploads.complete(upload_id))
+
+@app.route('/api/chunked_uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    """取消分片上传"""
+    chunked_uploads.abort(upload_id)
+    return jsonify({'success': True})
+
 @app.route('/api/set_prompt', methods=['POST'])
 def set_prompt():
     """设置初始prompt"""
@@ -392,7 +864,7 @@ def set_prompt():
         session_id = data.get('session_id', 'default')
         prompt = data.get('prompt', '')
         
-        initial_prompt[session_id] = prompt
+        session_store.set_prompt(session_id, prompt)
         return jsonify({'success': True})
         
     except Exception as e:
@@ -405,8 +877,11 @@ def clear_knowledge():
         data = request.get_json()
         session_id = data.get('session_id', 'default')
         
-        if session_id in knowledge_base:
-            knowledge_base[session_id] = []
+        session_store.clear_knowledge_refs(session_id)
+        knowledge = knowledge_base.get(session_id)
+        if knowledge is not None:
+            knowledge.clear()
+            knowledge_base.resize(session_id)
         
         return jsonify({'success': True})
         
@@ -415,9 +890,9 @@ def clear_knowledge():
 
 @app.route('/api/process_excel', methods=['POST'])
 def process_excel():
-    if 'file' not in request.files:
+    file = get_request_file()
+    if file is None:
         return jsonify({'error': '没有文件上传'}), 400
-    file = request.files['file']
     if file.filename == '':
         return jsonify({'error': '未选择文件'}), 400
 
@@ -638,12 +1113,6 @@ def excel_ai_process():
                         row_dict[col] = str(val)
                 data_preview.append(row_dict)
         
-        # 使用阿里云大模型API处理
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY}"
-        }
-        
         # 构造提示词，让AI直接返回处理后的数据
         prompt = f"""
 我需要你帮我处理一个Excel数据表格，根据用户指令修改数据。
@@ -705,31 +1174,19 @@ def excel_ai_process():
 ]
 """
         
-        payload = {
-            "model": "qwen-max",
-            "input": {
-                "messages": [
-                    {
-                        "role": "system", 
-                        "content": "你是一名专业的数据处理专家，善于理解用户需求并精确执行数据处理任务。你会直接提供处理后的数据，不要返回任何解释。"
-                    },
-                    {"role": "user", "content": prompt}
-                ]
+        messages = [
+            {
+                "role": "system", 
+                "content": "你是一名专业的数据处理专家，善于理解用户需求并精确执行数据处理任务。你会直接提供处理后的数据，不要返回任何解释。"
             },
-            "parameters": {
-                "temperature": 0.3,
-                "max_tokens": 4000
-            }
-        }
+            {"role": "user", "content": prompt}
+        ]
         
         # 调用API获取AI处理结果
-        response = requests.post(API_URL, headers=headers, json=payload)
-        
-        if response.status_code != 200:
-            return jsonify({'error': f'AI处理失败: {response.text}'}), 500
-        
-        # 提取AI响应
-        ai_response = response.json().get('output', {}).get('text', '')
+        try:
+            ai_response = llm.generate(messages, temperature=0.3, max_tokens=4000, endpoint='excel_ai_process', idempotent=True, use_cache='excel_ai_process' in LLM_CACHE_ENDPOINTS)
+        except LLMError as e:
+            return jsonify({'error': f'AI处理失败: {e.body or str(e)}'}), 503 if e.unavailable else 500
         
         # 尝试从响应中提取JSON数据
         processed_data = None
@@ -1051,135 +1508,255 @@ def download_analysis_file(filename):
             'filepath': filepath
         }), 500
 
-@app.route('/api/data_analysis', methods=['POST'])
-def data_analysis():
-    if 'file' not in request.files:
-        return jsonify({'error': '没有文件上传'}), 400
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': '未选择文件'}), 400
+ANALYSIS_STAGES = ['读取数据', '统计分析', 'AI分析', '生成图表', '保存结果']
 
-    if file and (file.filename.endswith('.xlsx') or file.filename.endswith('.xls') or file.filename.endswith('.csv')):
-        temp_filepath = None
-        try:
-            filename = secure_filename(file.filename)
-            temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(temp_filepath)
+def run_data_analysis(progress, filepath):
+    """对数据文件执行完整分析流程，返回响应数据；progress(stage) 用于上报阶段进度"""
+    # 读取Excel数据
+    progress('读取数据')
+    if filepath.endswith('.csv'):
+        df = pd.read_csv(filepath)
+    else:
+        df = pd.read_excel(filepath)
+
+    # 基本数据统计
+    progress('统计分析')
+    basic_stats = {
+        "rows": len(df),
+        "columns": len(df.columns),
+        "column_names": df.columns.tolist(),
+        "missing_values": df.isnull().sum().to_dict(),
+        "data_types": {col: str(df[col].dtype) for col in df.columns}
+    }
 
-            # 读取Excel数据
-            if file.filename.endswith('.csv'):
-                df = pd.read_csv(temp_filepath)
-            else:
-                df = pd.read_excel(temp_filepath)
-
-            # 基本数据统计
-            basic_stats = {
-                "rows": len(df),
-                "columns": len(df.columns),
-                "column_names": df.columns.tolist(),
-                "missing_values": df.isnull().sum().to_dict(),
-                "data_types": {col: str(df[col].dtype) for col in df.columns}
-            }
+    # 数值型列的统计信息
+    numeric_stats = {}
+    for col in df.select_dtypes(include=['number']).columns:
+        numeric_stats[col] = {
+            "mean": float(df[col].mean()) if not pd.isna(df[col].mean()) else None,
+            "median": float(df[col].median()) if not pd.isna(df[col].median()) else None,
+            "std": float(df[col].std()) if not pd.isna(df[col].std()) else None,
+            "min": float(df[col].min()) if not pd.isna(df[col].min()) else None,
+            "max": float(df[col].max()) if not pd.isna(df[col].max()) else None
+        }
 
-            # 数值型列的统计信息
-            numeric_stats = {}
-            for col in df.select_dtypes(include=['number']).columns:
-                numeric_stats[col] = {
-                    "mean": float(df[col].mean()) if not pd.isna(df[col].mean()) else None,
-                    "median": float(df[col].median()) if not pd.isna(df[col].median()) else None,
-                    "std": float(df[col].std()) if not pd.isna(df[col].std()) else None,
-                    "min": float(df[col].min()) if not pd.isna(df[col].min()) else None,
-                    "max": float(df[col].max()) if not pd.isna(df[col].max()) else None
-                }
+    # 分类列的统计信息
+    categorical_stats = {}
+    for col in df.select_dtypes(include=['object', 'category']).columns:
+        value_counts = df[col].value_counts().head(10).to_dict()  # 只取前10个类别
+        categorical_stats[col] = {
+            "unique_values": df[col].nunique(),
+            "top_categories": value_counts
+        }
 
-            # 分类列的统计信息
-            categorical_stats = {}
-            for col in df.select_dtypes(include=['object', 'category']).columns:
-                value_counts = df[col].value_counts().head(10).to_dict()  # 只取前10个类别
-                categorical_stats[col] = {
-                    "unique_values": df[col].nunique(),
-                    "top_categories": value_counts
-                }
+    # 生成数据预览
+    preview_data = df.head(10).to_json(orient='split')
+
+    # 生成分析ID
+    analysis_id = str(uuid.uuid4())
+
+    # 并发调用AI生成深度分析报告和可视化代码（两个提示词互不依赖）
+    progress('AI分析')
+    analysis_report, visualization_code = run_concurrently(
+        (generate_ai_analysis, df, basic_stats, numeric_stats, categorical_stats),
+        (generate_ai_visualization_code, df, numeric_stats, categorical_stats)
+    )
+
+    # 执行可视化代码并获取图像（matplotlib 全局状态非线程安全，串行绘图）
+    progress('生成图表')
+    with plot_lock:
+        visualization_result = execute_visualization_code(visualization_code, df, analysis_id)
+
+    # 保存分析结果
+    progress('保存结果')
+    result_filename = f'analysis_{analysis_id}.xlsx'
+    result_filepath = os.path.join(ANALYSIS_FOLDER, result_filename)
+
+    # 创建带有分析结果的Excel文件
+    with pd.ExcelWriter(result_filepath) as writer:
+        df.head(100).to_excel(writer, sheet_name='数据预览', index=False)
+
+        # 创建统计信息表
+        stats_df = pd.DataFrame({
+            "统计项": ["总行数", "总列数", "数值型列数", "类别型列数"],
+            "值": [
+                basic_stats["rows"], 
+                basic_stats["columns"],
+                len(numeric_stats),
+                len(categorical_stats)
+            ]
+        })
+        stats_df.to_excel(writer, sheet_name='基本统计', index=False)
+
+        # 将AI分析报告保存为单独的表格
+        pd.DataFrame({"AI分析报告": [analysis_report]}).to_excel(writer, sheet_name='AI分析', index=False)
+
+        # 将可视化代码保存为单独的表格
+        pd.DataFrame({"数据可视化代码": [visualization_code]}).to_excel(writer, sheet_name='可视化代码', index=False)
+
+    # 构建响应数据
+    response_data = {
+        'success': True,
+        'basic_stats': basic_stats,
+        'numeric_stats': numeric_stats,
+        'categorical_stats': categorical_stats,
+        'preview': preview_data,
+        'analysis_report': analysis_report,
+        'download_filename': result_filename,
+        'analysis_id': analysis_id
+    }
 
-            # 生成数据预览
-            preview_data = df.head(10).to_json(orient='split')
+    # 添加可视化结果
+    if visualization_result['success']:
+        response_data['visualization'] = {
+            'success': True,
+            'images': visualization_result['image_b64_list'],
+            'code': visualization_result['code']
+        }
+    else:
+        response_data['visualization'] = {
+            'success': False,
+            'error': visualization_result['error'],
+            'code': visualization_result['code']
+        }
 
-            # 生成分析ID
-            analysis_id = str(uuid.uuid4())
+    return response_data
 
-            # 使用AI生成深度分析报告
-            analysis_report = generate_ai_analysis(df, basic_stats, numeric_stats, categorical_stats)
-            
-            # 使用AI生成可视化代码
-            visualization_code = generate_ai_visualization_code(df, numeric_stats, categorical_stats)
-            
-            # 执行可视化代码并获取图像
-            visualization_result = execute_visualization_code(visualization_code, df, analysis_id)
-            
-            # 保存分析结果
-            result_filename = f'analysis_{analysis_id}.xlsx'
-            result_filepath = os.path.join(ANALYSIS_FOLDER, result_filename)
-            
-            # 创建带有分析结果的Excel文件
-            with pd.ExcelWriter(result_filepath) as writer:
-                df.head(100).to_excel(writer, sheet_name='数据预览', index=False)
-                
-                # 创建统计信息表
-                stats_df = pd.DataFrame({
-                    "统计项": ["总行数", "总列数", "数值型列数", "类别型列数"],
-                    "值": [
-                        basic_stats["rows"], 
-                        basic_stats["columns"],
-                        len(numeric_stats),
-                        len(categorical_stats)
-                    ]
-                })
-                stats_df.to_excel(writer, sheet_name='基本统计', index=False)
-                
-                # 将AI分析报告保存为单独的表格
-                pd.DataFrame({"AI分析报告": [analysis_report]}).to_excel(writer, sheet_name='AI分析', index=False)
-                
-                # 将可视化代码保存为单独的表格
-                pd.DataFrame({"数据可视化代码": [visualization_code]}).to_excel(writer, sheet_name='可视化代码', index=False)
+def save_analysis_upload(file, prefix=None):
+    """保存待分析的上传文件，返回临时文件路径"""
+    filename = secure_filename(file.filename)
+    if prefix:
+        filename = f"{prefix}_{filename}"
+    temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(temp_filepath)
+    return temp_filepath
 
-            # 清理临时文件
-            os.remove(temp_filepath)
+def is_analysis_file(filename):
+    """是否为支持分析的数据文件"""
+    return filename.endswith('.xlsx') or filename.endswith('.xls') or filename.endswith('.csv')
 
-            # 构建响应数据
-            response_data = {
-                'success': True,
-                'basic_stats': basic_stats,
-                'numeric_stats': numeric_stats,
-                'categorical_stats': categorical_stats,
-                'preview': preview_data,
-                'analysis_report': analysis_report,
-                'download_filename': result_filename,
-                'analysis_id': analysis_id
-            }
-            
-            # 添加可视化结果
-            if visualization_result['success']:
-                response_data['visualization'] = {
-                    'success': True,
-                    'images': visualization_result['image_b64_list'],
-                    'code': visualization_result['code']
-                }
-            else:
-                response_data['visualization'] = {
-                    'success': False,
-                    'error': visualization_result['error'],
-                    'code': visualization_result['code']
-                }
+@app.route('/api/data_analysis', methods=['POST'])
+def data_analysis():
+    file = get_request_file()
+    if file is None:
+        return jsonify({'error': '没有文件上传'}), 400
+    if file.filename == '':
+        return jsonify({'error': '未选择文件'}), 400
 
+    if file and is_analysis_file(file.filename):
+        temp_filepath = None
+        try:
+            temp_filepath = save_analysis_upload(file)
+            response_data = run_data_analysis(lambda stage, message=None: None, temp_filepath)
             return jsonify(response_data)
 
+        except LLMError as e:
+            if e.unavailable:
+                return jsonify({'error': f'AI服务繁忙，请稍后重试: {str(e)}'}), 503
+            return jsonify({'error': f'数据分析时发生错误: {str(e)}', 'traceback': traceback.format_exc()}), 500
         except Exception as e:
+            return jsonify({'error': f'数据分析时发生错误: {str(e)}', 'traceback': traceback.format_exc()}), 500
+        finally:
+            # 清理临时文件
             if temp_filepath and os.path.exists(temp_filepath):
                 os.remove(temp_filepath)
-            return jsonify({'error': f'数据分析时发生错误: {str(e)}', 'traceback': traceback.format_exc()}), 500
     else:
         return jsonify({'error': '不支持的文件类型，请上传 .xls, .xlsx 或 .csv 文件'}), 400
 
+def run_analysis_job(progress, filepath):
+    """后台任务：执行数据分析并在结束后清理临时文件"""
+    try:
+        return run_data_analysis(progress, filepath)
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+@app.route('/api/data_analysis/jobs', methods=['POST'])
+def submit_data_analysis_job():
+    """提交异步数据分析任务，立即返回任务ID"""
+    file = get_request_file()
+    if file is None:
+        return jsonify({'error': '没有文件上传'}), 400
+    if file.filename == '':
+        return jsonify({'error': '未选择文件'}), 400
+    if not is_analysis_file(file.filename):
+        return jsonify({'error': '不支持的文件类型，请上传 .xls, .xlsx 或 .csv 文件'}), 400
+
+    temp_filepath = None
+    try:
+        temp_filepath = save_analysis_upload(file, prefix=str(uuid.uuid4()))
+        job_id = analysis_jobs.submit(run_analysis_job, temp_filepath, stages=ANALYSIS_STAGES)
+        return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+    except QueueFullError as e:
+        if temp_filepath and os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        if temp_filepath and os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        return jsonify({'error': f'提交分析任务失败: {str(e)}'}), 500
+
+@app.route('/api/data_analysis/jobs/<job_id>', methods=['GET'])
+def get_data_analysis_job(job_id):
+    """获取分析任务的状态和阶段进度"""
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job)
+
+@app.route('/api/data_analysis/jobs/<job_id>/events', methods=['GET'])
+def subscribe_data_analysis_job(job_id):
+    """通过 SSE 订阅分析任务的状态变化，任务结束后关闭"""
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+
+    def generate():
+        current = job
+        while True:
+            yield sse_event(current, event='status')
+            if current['status'] in ('succeeded', 'failed'):
+                return
+            latest = analysis_jobs.wait_for_update(job_id, current['version'])
+            if latest is None:
+                return
+            if latest['version'] == current['version']:
+                # 保持连接的心跳
+                yield ": keep-alive\n\n"
+            current = latest
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/data_analysis/jobs/<job_id>/result', methods=['GET'])
+def get_data_analysis_job_result(job_id):
+    """获取分析任务的结果，任务未完成时返回202"""
+    job = analysis_jobs.get(job_id, include_result=True)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': f'数据分析时发生错误: {job["error"]}', 'status': 'failed'}), 500
+    if job['status'] != 'succeeded':
+        return jsonify({'status': job['status'], 'stage': job['stage']}), 202
+    return jsonify(job['result'])
+
+def run_concurrently(*tasks):
+    """在分析线程池中并发执行相互独立的任务，按提交顺序返回结果
+    
+    每个任务为 (函数, 参数...) 元组。任一任务抛出异常时取消尚未开始的任务并重新抛出该异常。
+    """
+    futures = [analysis_executor.submit(func, *args) for func, *args in tasks]
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in futures:
+        if future in done and future.exception() is not None:
+            for pending in not_done:
+                pending.cancel()
+            raise future.exception()
+    return [future.result() for future in futures]
+
 def generate_ai_analysis(df, basic_stats, numeric_stats, categorical_stats):
     """使用AI生成数据分析报告"""
     try:
@@ -1204,12 +1781,6 @@ def generate_ai_analysis(df, basic_stats, numeric_stats, categorical_stats):
         data_sample = df[preview_cols].head(5).to_string()
         data_summary += f"\n数据样例（前5行）:\n{data_sample}\n"
 
-        # 构造AI请求
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY}"
-        }
-
         prompt = f"""
 作为一名专业的数据分析师，请基于以下数据信息，提供一份深入的数据分析报告。
 这份报告至少包含：
@@ -1226,32 +1797,25 @@ def generate_ai_analysis(df, basic_stats, numeric_stats, categorical_stats):
 请提供一份专业、有深度且有洞察力的分析报告，尽量挖掘数据中的价值和模式。报告应该是结构化的，便于阅读，并包含实际可行的建议。
 """
 
-        payload = {
-            "model": "qwen-max",
-            "input": {
-                "messages": [
-                    {
-                        "role": "system", 
-                        "content": "你是一名专业的数据分析师，擅长从数据中发现洞察和价值，并提供专业的分析报告。"
-                    },
-                    {"role": "user", "content": prompt}
-                ]
+        messages = [
+            {
+                "role": "system", 
+                "content": "你是一名专业的数据分析师，擅长从数据中发现洞察和价值，并提供专业的分析报告。"
             },
-            "parameters": {
-                "temperature": 0.5,
-                "max_tokens": 2000
-            }
-        }
+            {"role": "user", "content": prompt}
+        ]
 
         # 调用API获取分析报告
-        response = requests.post(API_URL, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            ai_response = response.json().get('output', {}).get('text', '')
-            return ai_response
-        else:
-            return f"AI分析生成失败: HTTP {response.status_code} - {response.text}"
-
+        try:
+            return llm.generate(messages, temperature=0.5, max_tokens=2000, endpoint='data_analysis_report', idempotent=True, use_cache='data_analysis' in LLM_CACHE_ENDPOINTS)
+        except LLMError as e:
+            # 上游限流或熔断时直接失败，由调用方取消并发的其他调用
+            if e.unavailable:
+                raise
+            return f"AI分析生成失败: {str(e)}"
+
+    except LLMError:
+        raise
     except Exception as e:
         return f"生成AI分析报告时出错: {str(e)}"
 
@@ -1297,12 +1861,6 @@ def generate_ai_visualization_code(df, numeric_stats, categorical_stats):
         # 提供一些数据示例
         data_description += f"\n数据示例（前3行）:\n{df.head(3).to_string()}\n"
         
-        # 构造AI请求
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY}"
-        }
-
         prompt = f"""
 请为以下数据生成5种不同类型的数据可视化Python代码。
 
@@ -1343,41 +1901,34 @@ plt.ylabel("中文纵轴", fontproperties='SimHei')
 仅返回可执行的Python代码，不要有解释性文字。
 """
 
-        payload = {
-            "model": "qwen-max",
-            "input": {
-                "messages": [
-                    {
-                        "role": "system", 
-                        "content": "你是一名数据可视化专家，精通使用Python进行数据可视化编程。你的代码必须是可执行的，没有语法错误，并且能够处理各种不同的数据集。"
-                    },
-                    {"role": "user", "content": prompt}
-                ]
+        messages = [
+            {
+                "role": "system", 
+                "content": "你是一名数据可视化专家，精通使用Python进行数据可视化编程。你的代码必须是可执行的，没有语法错误，并且能够处理各种不同的数据集。"
             },
-            "parameters": {
-                "temperature": 0.3,
-                "max_tokens": 3000
-            }
-        }
+            {"role": "user", "content": prompt}
+        ]
 
         # 调用API获取可视化代码
-        response = requests.post(API_URL, headers=headers, json=payload)
+        try:
+            ai_response = llm.generate(messages, temperature=0.3, max_tokens=3000, endpoint='data_analysis_chart', idempotent=True, use_cache='data_analysis' in LLM_CACHE_ENDPOINTS)
+        except LLMError as e:
+            if e.unavailable:
+                raise
+            return f"生成可视化代码失败: HTTP {e.status_code}" if e.status_code else f"生成可视化代码失败: {str(e)}"
         
-        if response.status_code == 200:
-            ai_response = response.json().get('output', {}).get('text', '')
-            
-            # 提取代码块
-            code_pattern = r"```python\s*(.*?)\s*```"
-            code_match = re.search(code_pattern, ai_response, re.DOTALL)
-            
-            if code_match:
-                return code_match.group(1).strip()
-            else:
-                # 如果没有代码块标记，尝试直接使用整个响应
-                return ai_response.strip()
+        # 提取代码块
+        code_pattern = r"```python\s*(.*?)\s*```"
+        code_match = re.search(code_pattern, ai_response, re.DOTALL)
+        
+        if code_match:
+            return code_match.group(1).strip()
         else:
-            return f"生成可视化代码失败: HTTP {response.status_code}"
+            # 如果没有代码块标记，尝试直接使用整个响应
+            return ai_response.strip()
 
+    except LLMError:
+        raise
     except Exception as e:
         return f"生成可视化代码时出错: {str(e)}"
 
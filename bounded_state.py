@@ -0,0 +1,146 @@
+"""有界的进程内状态
+
+按会话保存的进程内状态（知识库引用、内存会话存储中的会话和 prompt）放在 BoundedState 中：
+限制条目数和估算的字节数，超过空闲时间未访问的条目过期，超限时按最近最少使用淘汰。
+条目被淘汰时调用 on_evict(key, value)，由调用方释放资源或写入持久层。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class BoundedState:
+    """带容量上限、空闲过期和 LRU 淘汰的字典"""
+
+    def __init__(self, max_entries=None, max_bytes=None, idle_ttl=None, sizeof=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self.on_evict = on_evict
+        self._entries = OrderedDict()   # key -> [value, size, last_access]，按访问时间从旧到新
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.stats_counter = {'evictions': 0, 'expirations': 0}
+
+    def _collect(self, protected=None):
+        """取出过期和超出容量的条目，返回 [(key, value)]，需持有锁"""
+        removed = []
+        if self.idle_ttl:
+            deadline = time.time() - self.idle_ttl
+            # 条目按访问时间排列，过期的都在头部
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if entry[2] > deadline:
+                    break
+                self._remove(key)
+                removed.append((key, entry[0]))
+                self.stats_counter['expirations'] += 1
+        # 只剩一条时保留它，即使单条超过字节上限；之后的访问也不会再把它淘汰
+        while self._over_capacity() and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == protected:
+                # 刚写入的条目最后淘汰
+                self._entries.move_to_end(key)
+                continue
+            value = self._remove(key)
+            removed.append((key, value))
+            self.stats_counter['evictions'] += 1
+        return removed
+
+    def _over_capacity(self):
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self._bytes > self.max_bytes
+
+    def _remove(self, key):
+        value, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        return value
+
+    def _notify(self, removed):
+        if self.on_evict:
+            for key, value in removed:
+                self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        """获取条目并刷新访问时间"""
+        with self._lock:
+            removed = self._collect()
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[2] = time.time()
+                self._entries.move_to_end(key)
+        self._notify(removed)
+        return entry[0] if entry is not None else default
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            size = self.sizeof(value)
+            self._entries[key] = [value, size, time.time()]
+            self._bytes += size
+            removed = self._collect(protected=key)
+        self._notify(removed)
+
+    def peek(self, key, default=None):
+        """获取条目，不刷新访问时间"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else default
+
+    def expire(self):
+        """立即清理过期和超出容量的条目"""
+        with self._lock:
+            removed = self._collect()
+        self._notify(removed)
+
+    def setdefault(self, key, factory):
+        """条目不存在时用 factory() 创建，返回条目"""
+        with self._lock:
+            value = self.get(key)
+            if value is None:
+                value = factory()
+                self.set(key, value)
+            return value
+
+    def resize(self, key):
+        """条目内容变化后重新计算大小，可能触发淘汰"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            size = self.sizeof(entry[0])
+            self._bytes += size - entry[1]
+            entry[1] = size
+            removed = self._collect(protected=key)
+        self._notify(removed)
+
+    def pop(self, key, default=None):
+        """移除条目（不调用 on_evict）"""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def values(self):
+        with self._lock:
+            return [entry[0] for entry in self._entries.values()]
+
+    def stats(self):
+        with self._lock:
+            removed = self._collect()
+            stats = dict(self.stats_counter)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        self._notify(removed)
+        return stats
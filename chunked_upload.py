@@ -0,0 +1,230 @@
+"""可续传的分片上传
+
+大文件先 init 创建上传任务，再按偏移量逐片 PUT，最后 complete 校验完整文件的 SHA-256。
+分片直接写入磁盘上的 .part 文件，上传进度保存在同目录的 JSON 文件中，
+连接中断或服务重启后客户端查询已接收的字节数即可从断点继续。
+完成的文件以 ChunkedFile 交给各处理接口，通过重命名移动到目标路径，不再复制。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """分片上传请求无效"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ChunkedFile:
+    """已完成的分片上传文件，提供与 werkzeug FileStorage 相同的 filename 和 save()"""
+
+    def __init__(self, store, upload_id, filename, sha256):
+        self.store = store
+        self.upload_id = upload_id
+        self.filename = filename
+        self.sha256 = sha256
+
+    def save(self, dst):
+        """把文件移动到 dst，上传任务随之结束"""
+        self.store.claim(self.upload_id, dst)
+
+
+class ChunkedUploadStore:
+    """分片上传任务的磁盘存储"""
+
+    def __init__(self, root, max_size=1024 * 1024 * 1024, chunk_size=8 * 1024 * 1024, ttl=24 * 3600):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.root, f"{upload_id}.part")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.root, f"{upload_id}.json")
+
+    def _check_id(self, upload_id):
+        # upload_id 来自 URL，只接受 uuid 格式，防止路径穿越
+        try:
+            uuid.UUID(upload_id)
+        except ValueError:
+            raise UploadError('上传任务不存在', 404)
+
+    def _upload_lock(self, upload_id):
+        # 只为存在的上传任务创建锁，避免随意编造的 upload_id 让锁表无限增长；
+        # 在 self._lock 内检查，与 _remove 删除文件后移除锁互斥
+        self._check_id(upload_id)
+        with self._lock:
+            if not os.path.exists(self._meta_path(upload_id)):
+                raise UploadError('上传任务不存在', 404)
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
+
+    def _load(self, upload_id):
+        self._check_id(upload_id)
+        try:
+            with open(self._meta_path(upload_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise UploadError('上传任务不存在', 404)
+
+    def _save(self, meta):
+        meta['updated_at'] = time.time()
+        temp_path = self._meta_path(meta['id']) + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(temp_path, self._meta_path(meta['id']))
+
+    def _remove(self, upload_id):
+        for path in (self._part_path(upload_id), self._meta_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+
+    def purge_expired(self):
+        """删除超过保留时间未更新的上传任务"""
+        now = time.time()
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    self._remove(name[:-len('.json')])
+            except OSError:
+                continue
+
+    def public(self, meta):
+        """返回给客户端的上传状态"""
+        return {
+            'upload_id': meta['id'],
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'received': meta['received'],
+            'status': meta['status'],
+            'chunk_size': self.chunk_size
+        }
+
+    def init(self, filename, size, sha256=None):
+        """创建上传任务"""
+        if not filename or not secure_filename(filename):
+            raise UploadError('文件名无效')
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('文件大小无效')
+        if size > self.max_size:
+            raise UploadError(f'文件超过大小限制 {self.max_size // (1024 * 1024)}MB', 413)
+        self.purge_expired()
+
+        upload_id = str(uuid.uuid4())
+        open(self._part_path(upload_id), 'wb').close()
+        meta = {
+            'id': upload_id,
+            'filename': filename,
+            'size': size,
+            'sha256': sha256.lower() if sha256 else None,
+            'received': 0,
+            'status': 'uploading',
+            'created_at': time.time()
+        }
+        self._save(meta)
+        return self.public(meta)
+
+    def status(self, upload_id):
+        return self.public(self._load(upload_id))
+
+    def write_chunk(self, upload_id, offset, stream, chunk_sha256=None):
+        """从 stream 读取一个分片写入 offset 处，返回最新状态
+
+        offset 必须等于已接收的字节数；分片校验失败时丢弃已写入的部分。
+        """
+        with self._upload_lock(upload_id):
+            meta = self._load(upload_id)
+            if meta['status'] != 'uploading':
+                raise UploadError('上传任务已完成', 409)
+            if offset != meta['received']:
+                raise UploadError(f"偏移量不匹配，应从 {meta['received']} 继续上传", 409)
+
+            digest = hashlib.sha256()
+            written = 0
+            with open(self._part_path(upload_id), 'r+b') as f:
+                # 丢弃上次中断时未确认的数据
+                f.truncate(offset)
+                f.seek(offset)
+                while True:
+                    data = stream.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    written += len(data)
+                    if written > self.chunk_size or offset + written > meta['size']:
+                        f.truncate(offset)
+                        raise UploadError('分片超过大小限制', 413)
+                    digest.update(data)
+                    f.write(data)
+                if written == 0:
+                    raise UploadError('分片为空')
+                if chunk_sha256 and digest.hexdigest() != chunk_sha256.lower():
+                    f.truncate(offset)
+                    raise UploadError('分片校验失败，请重新上传该分片')
+
+            meta['received'] = offset + written
+            self._save(meta)
+            return self.public(meta)
+
+    def complete(self, upload_id):
+        """所有分片上传完毕后校验整个文件"""
+        with self._upload_lock(upload_id):
+            meta = self._load(upload_id)
+            if meta['status'] == 'complete':
+                return self.public(meta)
+            if meta['received'] != meta['size']:
+                raise UploadError(f"文件尚未上传完整：已接收 {meta['received']} / {meta['size']} 字节", 409)
+
+            digest = hashlib.sha256()
+            with open(self._part_path(upload_id), 'rb') as f:
+                for data in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                    digest.update(data)
+            if meta['sha256'] and digest.hexdigest() != meta['sha256']:
+                self._remove(upload_id)
+                raise UploadError('文件校验失败，请重新上传', 422)
+
+            meta['sha256'] = digest.hexdigest()
+            meta['status'] = 'complete'
+            self._save(meta)
+            return dict(self.public(meta), sha256=meta['sha256'])
+
+    def get_completed(self, upload_id):
+        """获取已完成的上传文件"""
+        meta = self._load(upload_id)
+        if meta['status'] != 'complete':
+            raise UploadError('文件尚未上传完成', 409)
+        return ChunkedFile(self, upload_id, meta['filename'], meta['sha256'])
+
+    def claim(self, upload_id, dst):
+        """把已完成的文件移动到 dst 并删除上传任务"""
+        with self._upload_lock(upload_id):
+            meta = self._load(upload_id)
+            if meta['status'] != 'complete':
+                raise UploadError('文件尚未上传完成', 409)
+            os.replace(self._part_path(upload_id), dst)
+            self._remove(upload_id)
+
+    def abort(self, upload_id):
+        """取消上传并删除已接收的数据"""
+        with self._upload_lock(upload_id):
+            self._load(upload_id)
+            self._remove(upload_id)
@@ -0,0 +1,117 @@
+"""已解析文档的内容寻址缓存
+
+上传文件在写入磁盘的同时计算 SHA-256，以文件内容哈希（加文件类型）为键，
+把提取出的文本保存在缓存目录中。同一份文件无论上传到哪个会话都只解析一次。
+缓存总大小超过上限时，按最近访问时间淘汰最旧的条目。
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def save_and_hash(stream, filepath, chunk_size=HASH_CHUNK_SIZE):
+    """分块把上传流写入 filepath，同时计算内容哈希，返回 (sha256 十六进制摘要, 字节数)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(filepath, 'wb') as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class DocumentCache:
+    """以内容哈希为键、按总字节数限制容量的磁盘文本缓存"""
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.stats_counter = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        if not os.path.exists(root):
+            os.makedirs(root)
+        # 启动时统计已有缓存的大小
+        self._total_bytes = sum(os.path.getsize(path) for path in self._entries())
+
+    def _path(self, digest, kind):
+        # 按哈希前两位分目录，避免单个目录文件过多
+        return os.path.join(self.root, digest[:2], f"{digest}.{kind or 'bin'}.txt")
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.txt'):
+                    yield os.path.join(dirpath, filename)
+
+    def get(self, digest, kind):
+        """读取缓存的文本，未命中返回 None"""
+        path = self._path(digest, kind)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except OSError:
+            with self._lock:
+                self.stats_counter['misses'] += 1
+            return None
+        try:
+            # 更新访问时间，淘汰时按它排序
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.stats_counter['hits'] += 1
+        return text
+
+    def set(self, digest, kind, text):
+        """写入缓存（先写临时文件再原子替换），超出容量时淘汰最久未访问的条目"""
+        path = self._path(digest, kind)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        data = text.encode('utf-8')
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp_path, path)
+            self._total_bytes += len(data) - previous
+            self.stats_counter['stores'] += 1
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """淘汰到总大小不超过上限的 90%（需持有锁）"""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self._total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_bytes -= size
+            self.stats_counter['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counter)
+            stats['bytes'] = self._total_bytes
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,212 @@
+"""内容寻址的共享文档存储
+
+每份文档（按内容哈希和文件类型区分）只切分、索引并保存一次，带引用计数；
+会话的知识库只保存对文档的轻量引用，同一份资料加载到多少个会话都只占一份内存。
+引用计数归零的文档立即从存储中删除。
+"""
+import threading
+
+from knowledge_index import create_index, search_indexes
+
+
+class DocumentStore:
+    """文档键 -> 单文档检索索引，按引用计数管理生命周期"""
+
+    def __init__(self, kind='bm25', chunk_size=500):
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self._documents = {}   # 文档键 -> {'index', 'content_length', 'chunk_count', 'digest', 'refs'}
+        self._lock = threading.Lock()
+        self.stats_counter = {'stores': 0, 'shared': 0, 'evictions': 0}
+
+    def acquire(self, key):
+        """文档已在存储中时增加引用并返回文档信息，否则返回 None"""
+        with self._lock:
+            document = self._documents.get(key)
+            if document is None:
+                return None
+            document['refs'] += 1
+            self.stats_counter['shared'] += 1
+            return document
+
+    def add(self, key, text):
+        """切分并索引文档后以引用计数 1 加入存储，返回文档信息
+
+        文本块的 source 记为文档键，由引用它的会话换成各自的文件名。
+        并发入库同一文档时只保留先完成的一份，后完成的直接增加引用。
+        """
+        index = create_index(self.kind, self.chunk_size)
+        chunk_count = index.add_document(key, text)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                document['refs'] += 1
+                self.stats_counter['shared'] += 1
+                return document
+            document = {
+                'index': index,
+                'content_length': len(text),
+                'chunk_count': chunk_count,
+                'digest': None,
+                'refs': 1
+            }
+            self._documents[key] = document
+            self.stats_counter['stores'] += 1
+            return document
+
+    def release(self, key):
+        """减少引用，引用归零时删除文档"""
+        with self._lock:
+            document = self._documents.get(key)
+            if document is None:
+                return
+            document['refs'] -= 1
+            if document['refs'] <= 0:
+                del self._documents[key]
+                self.stats_counter['evictions'] += 1
+
+    def get(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            return document['index'] if document else None
+
+    def content_length(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            return document['content_length'] if document else 0
+
+    def set_digest(self, key, digest):
+        """保存文档摘要"""
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                document['digest'] = digest
+
+    def get_digest(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            return document['digest'] if document else None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counter)
+            stats['documents'] = len(self._documents)
+            stats['references'] = sum(document['refs'] for document in self._documents.values())
+            stats['chunks'] = sum(document['chunk_count'] for document in self._documents.values())
+            stats['content_chars'] = sum(document['content_length'] for document in self._documents.values())
+            stats['digests'] = sum(1 for document in self._documents.values() if document['digest'])
+        return stats
+
+
+class SessionKnowledge:
+    """会话知识库：对共享文档的引用列表，检索时在所有引用的文档上联合检索"""
+
+    def __init__(self, store, session_id=None):
+        self.store = store
+        self.session_id = session_id
+        self._refs = []        # [(文档键, 本会话中的文件名)]
+        self.missing = []      # 最近一次同步时无法加载的文档的文件名
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._refs)
+
+    def _add_ref(self, key, filename):
+        """记录引用；同一会话重复上传同一文档或知识库已关闭时归还引用"""
+        with self._lock:
+            if self._closed or any(ref_key == key for ref_key, _ in self._refs):
+                duplicate = True
+            else:
+                self._refs.append((key, filename))
+                duplicate = False
+        if duplicate:
+            self.store.release(key)
+
+    def attach(self, key, filename):
+        """引用调用方已从共享存储取得（acquire/add）的文档，引用随之转交给知识库"""
+        self._add_ref(key, filename)
+
+    def sync(self, refs, load_document):
+        """与持久化的引用列表 [(文档键, 文件名)] 对齐
+
+        其他进程加入的文档先尝试从共享存储引用，不在存储中时由 load_document(key)
+        重新加载（返回已取得引用的文档信息或 None），加载失败的文档记入 missing；
+        列表中已不存在的文档释放引用。
+        """
+        wanted = dict(refs)
+        with self._lock:
+            removed = [key for key, _ in self._refs if key not in wanted]
+            current = {key for key, _ in self._refs}
+            self._refs = [(key, filename) for key, filename in self._refs if key in wanted]
+        for key in removed:
+            self.store.release(key)
+        missing = []
+        for key, filename in refs:
+            if key in current:
+                continue
+            document = self.store.acquire(key) or load_document(key)
+            if document is not None:
+                self._add_ref(key, filename)
+            else:
+                missing.append(filename)
+        self.missing = missing
+
+    def content_chars(self):
+        """引用的文档文本总字符数，用于估算内存占用"""
+        with self._lock:
+            keys = [key for key, _ in self._refs]
+        return sum(self.store.content_length(key) for key in keys)
+
+    def _indexes(self):
+        """返回 (引用的文档索引列表, {文档键: 本会话中的文件名})"""
+        with self._lock:
+            refs = list(self._refs)
+        indexes = []
+        for key, _ in refs:
+            index = self.store.get(key)
+            if index is not None:
+                indexes.append(index)
+        return indexes, dict(refs)
+
+    @staticmethod
+    def _with_session_names(chunks, names):
+        return [dict(chunk, source=names.get(chunk['source'], chunk['source'])) for chunk in chunks]
+
+    def search(self, query, top_k=5):
+        indexes, names = self._indexes()
+        return self._with_session_names(search_indexes(indexes, query, top_k), names)
+
+    def leading_chunks(self, limit=5):
+        """每篇文档的开头文本块"""
+        indexes, names = self._indexes()
+        chunks = []
+        for index in indexes[:limit]:
+            chunks.extend(index.leading_chunks(1))
+        return self._with_session_names(chunks, names)
+
+    def digests(self):
+        """返回已生成摘要的文档 [(文件名, 摘要)]"""
+        with self._lock:
+            refs = list(self._refs)
+        result = []
+        for key, filename in refs:
+            digest = self.store.get_digest(key)
+            if digest:
+                result.append((filename, digest))
+        return result
+
+    def clear(self):
+        """清空知识库并释放所有文档引用"""
+        with self._lock:
+            refs = self._refs
+            self._refs = []
+        for key, _ in refs:
+            self.store.release(key)
+
+    def close(self):
+        """释放所有文档引用，之后加入的文档立即归还（用于淘汰时仍有入库任务持有该知识库的情况）"""
+        with self._lock:
+            self._closed = True
+        self.clear()
@@ -0,0 +1,67 @@
+"""大文档的 map-reduce 摘要
+
+文档按段落切分为若干节，各节摘要在有界线程池中并发调用大模型生成（map），
+再把各节摘要合并为整篇文档的摘要（reduce）；节摘要合起来仍然过长时分组逐层合并。
+"""
+from knowledge_index import split_into_chunks
+
+SECTION_PROMPT = "请用简洁的中文概括以下文档片段的要点，保留关键事实、数据和结论，不超过{limit}字：\n\n{text}"
+REDUCE_PROMPT = "以下是文档《{filename}》各部分的摘要，请将它们整合为一份不超过{limit}字的整体摘要，保留关键事实、数据和结论：\n\n{text}"
+
+
+class DocumentSummarizer:
+    """用大模型对长文档做 map-reduce 摘要"""
+
+    def __init__(self, llm, executor, section_chars=6000, section_summary_chars=300, digest_chars=800,
+                 model='qwen-max', use_cache=False):
+        self.llm = llm
+        self.executor = executor
+        self.section_chars = section_chars
+        self.section_summary_chars = section_summary_chars
+        self.digest_chars = digest_chars
+        self.model = model
+        self.use_cache = use_cache
+
+    def _generate(self, prompt):
+        # 温度调低使结果稳定；是否走响应缓存由 LLM_CACHE_ENDPOINTS 配置
+        return self.llm.generate(
+            [{"role": "user", "content": prompt}],
+            self.model,
+            use_cache=self.use_cache,
+            endpoint='document_summary',
+            idempotent=True,
+            temperature=0.3
+        ).strip()
+
+    def _map(self, prompt_template, texts, limit, **fields):
+        """并发为每段文本生成摘要，结果按输入顺序返回"""
+        prompts = [prompt_template.format(text=text, limit=limit, **fields) for text in texts]
+        return list(self.executor.map(self._generate, prompts))
+
+    def summarize(self, text, filename='', progress=None):
+        """返回整篇文档的摘要；progress(message) 用于报告进度"""
+        sections = split_into_chunks(text, self.section_chars, overlap=0)
+        if progress:
+            progress(f'分{len(sections)}节生成摘要')
+        summaries = self._map(SECTION_PROMPT, sections, self.section_summary_chars)
+
+        # 节摘要合起来超过一次提示词的容量时，分组合并后再继续
+        level = 1
+        while len(summaries) > 1 and sum(len(summary) for summary in summaries) > self.section_chars:
+            groups = split_into_chunks('\n\n'.join(summaries), self.section_chars, overlap=0)
+            if len(groups) >= len(summaries):
+                break
+            if progress:
+                progress(f'第{level}轮合并，共{len(groups)}组')
+            summaries = self._map(REDUCE_PROMPT, groups, self.digest_chars, filename=filename)
+            level += 1
+
+        if len(summaries) == 1 and len(sections) == 1:
+            return summaries[0]
+        if progress:
+            progress('合并整体摘要')
+        return self._generate(REDUCE_PROMPT.format(
+            filename=filename,
+            limit=self.digest_chars,
+            text='\n\n'.join(summaries)
+        ))
@@ -0,0 +1,84 @@
+"""DOCX 流式文本提取
+
+直接从 zip 包中流式读取 word/document.xml，用 iterparse 增量解析，
+按文档顺序逐个产出段落和表格行（单元格之间以 " | " 分隔），
+已处理的 XML 元素随即释放，不构建 python-docx 的完整文档对象，内存占用与文档大小无关。
+"""
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+W_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DOCUMENT_PART = 'word/document.xml'
+
+_BODY = W_NAMESPACE + 'body'
+_PARAGRAPH = W_NAMESPACE + 'p'
+_TEXT = W_NAMESPACE + 't'
+_TAB = W_NAMESPACE + 'tab'
+_BREAKS = (W_NAMESPACE + 'br', W_NAMESPACE + 'cr')
+_TABLE = W_NAMESPACE + 'tbl'
+_ROW = W_NAMESPACE + 'tr'
+_CELL = W_NAMESPACE + 'tc'
+
+CELL_SEPARATOR = ' | '
+
+
+def iter_docx_blocks(filepath):
+    """按文档顺序逐个产出非空的段落文本和表格行文本"""
+    with zipfile.ZipFile(filepath) as archive, archive.open(DOCUMENT_PART) as stream:
+        body = None
+        depth = 0
+        body_depth = None
+        runs = []          # 当前段落的文本片段
+        cells = []         # 每层表格当前行的单元格列表（支持嵌套表格）
+        cell_texts = []    # 每层表格当前单元格内的段落
+
+        for event, element in iterparse(stream, events=('start', 'end')):
+            tag = element.tag
+            if event == 'start':
+                depth += 1
+                if tag == _BODY:
+                    body = element
+                    body_depth = depth
+                elif tag == _ROW:
+                    cells.append([])
+                elif tag == _CELL:
+                    cell_texts.append([])
+                continue
+
+            depth -= 1
+            if tag == _TEXT:
+                runs.append(element.text or '')
+            elif tag == _TAB:
+                runs.append('\t')
+            elif tag in _BREAKS:
+                runs.append('\n')
+            elif tag == _PARAGRAPH:
+                text = ''.join(runs).strip()
+                runs = []
+                if cell_texts:
+                    if text:
+                        cell_texts[-1].append(text)
+                elif text:
+                    yield text
+            elif tag == _CELL:
+                cell = ' '.join(cell_texts.pop())
+                if cells:
+                    cells[-1].append(cell)
+            elif tag == _ROW:
+                row = cells.pop()
+                if any(row):
+                    row_text = CELL_SEPARATOR.join(row)
+                    if cell_texts:
+                        # 嵌套表格的行并入外层单元格
+                        cell_texts[-1].append(row_text)
+                    else:
+                        yield row_text
+
+            # body 的直接子元素处理完后释放，保持内存占用平稳
+            if body is not None and depth == body_depth:
+                body.clear()
+
+
+def read_docx_text(filepath):
+    """提取整个 DOCX 的文本，段落和表格行之间以换行分隔"""
+    return '\n'.join(iter_docx_blocks(filepath))
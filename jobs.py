@@ -0,0 +1,128 @@
+"""后台任务管理
+
+耗时的分析任务提交到有界线程池中执行，调用方拿到任务ID后
+通过轮询或订阅获取状态、阶段进度，完成后再获取结果。
+已结束的任务（含结果）保留 retention_seconds 秒，且最多保留 max_finished 个，超出时先删除最早结束的任务。
+"""
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bounded_state import BoundedState
+
+
+class QueueFullError(Exception):
+    """任务队列已满"""
+
+
+class JobManager:
+    """有界线程池 + 任务状态表"""
+
+    def __init__(self, max_workers=2, queue_depth=8, retention_seconds=3600, max_finished=100, name='job'):
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._jobs = {}
+        self._condition = threading.Condition()
+        # 已结束任务按结束时间排列（查询不刷新），过期或超出数量时从任务表中删除
+        self._finished = BoundedState(max_entries=max_finished, idle_ttl=retention_seconds, on_evict=self._forget)
+
+    def _active_count(self):
+        return sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+
+    def _forget(self, job_id, _):
+        with self._condition:
+            self._jobs.pop(job_id, None)
+            self._condition.notify_all()
+
+    def submit(self, func, *args, stages=None, **kwargs):
+        """提交任务，func 的第一个参数为进度回调 progress(stage, message=None)"""
+        self._finished.expire()
+        with self._condition:
+            if self._active_count() >= self.max_workers + self.queue_depth:
+                raise QueueFullError('任务队列已满，请稍后重试')
+
+            job_id = str(uuid.uuid4())
+            now = datetime.now().isoformat()
+            self._jobs[job_id] = {
+                'id': job_id,
+                'status': 'queued',
+                'stage': None,
+                'stages': list(stages or []),
+                'completed_stages': [],
+                'message': None,
+                'result': None,
+                'error': None,
+                'created_at': now,
+                'updated_at': now,
+                'version': 0
+            }
+
+        self._executor.submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    def _update(self, job_id, **changes):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            # 进入新阶段或任务完成时，上一阶段记为已完成
+            previous = job['stage']
+            if previous and 'stage' in changes and changes['stage'] != previous:
+                job['completed_stages'].append(previous)
+            job.update(changes)
+            job['updated_at'] = datetime.now().isoformat()
+            job['version'] += 1
+            self._condition.notify_all()
+
+    def _run(self, job_id, func, args, kwargs):
+        def progress(stage, message=None):
+            self._update(job_id, stage=stage, message=message)
+
+        self._update(job_id, status='running')
+        try:
+            result = func(progress, *args, **kwargs)
+        except Exception as e:
+            print(f"后台任务 {job_id} 执行失败: {str(e)}\n{traceback.format_exc()}")
+            self._update(job_id, status='failed', error=str(e))
+        else:
+            self._update(job_id, status='succeeded', stage=None, message=None, result=result)
+        self._finished.set(job_id, True)
+
+    def get(self, job_id, include_result=False):
+        """获取任务状态（默认不含结果），任务不存在时返回 None"""
+        self._finished.expire()
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {k: v for k, v in job.items() if not k.startswith('_') and k != 'result'}
+            snapshot['completed_stages'] = list(job['completed_stages'])
+            if include_result:
+                snapshot['result'] = job['result']
+            return snapshot
+
+    def wait_for_update(self, job_id, version, timeout=15):
+        """阻塞等待任务状态版本号超过 version 或超时，返回最新状态"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: job_id not in self._jobs or self._jobs[job_id]['version'] > version,
+                timeout=timeout
+            )
+        return self.get(job_id)
+
+    def stats(self):
+        """返回队列使用情况"""
+        self._finished.expire()
+        with self._condition:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        return {
+            'max_workers': self.max_workers,
+            'queue_depth': self.queue_depth,
+            'jobs': counts
+        }
@@ -0,0 +1,260 @@
+"""知识库分块检索
+
+上传文档的完整文本按段落切分为文本块，对话时只把与问题最相关的前 k 个文本块放入提示词。
+
+- BM25Index：jieba 分词后建立 BM25 倒排索引（关键词检索）
+- VectorIndex：字符 n-gram 哈希向量的稀疏矩阵，一次矩阵乘法计算余弦相似度
+"""
+import heapq
+import logging
+import math
+import re
+import threading
+
+import jieba
+import numpy as np
+
+jieba.setLogLevel(logging.WARNING)
+
+# 纯标点/空白的词不参与检索
+_PUNCT_PATTERN = re.compile(r'^[\W_]+$')
+
+# 常见的无意义虚词
+STOPWORDS = {
+    '的', '了', '和', '是', '在', '就', '都', '而', '及', '与', '着', '或', '一个', '没有',
+    '我们', '你们', '他们', '这', '那', '之', '也', '吗', '呢', '吧', '啊', '请', '什么', '怎么',
+    'the', 'a', 'an', 'of', 'to', 'and', 'or', 'is', 'are', 'in', 'on', 'for'
+}
+
+
+def tokenize(text):
+    """分词并过滤标点和停用词"""
+    tokens = []
+    for token in jieba.lcut_for_search(text.lower()):
+        token = token.strip()
+        if not token or token in STOPWORDS or _PUNCT_PATTERN.match(token):
+            continue
+        tokens.append(token)
+    return tokens
+
+
+def split_into_chunks(text, chunk_size=500, overlap=50):
+    """按段落把文本切分为约 chunk_size 字符的块，过长的段落按固定长度切分并保留重叠"""
+    # 重叠不小于块长时切分不会前进，限制为至多 chunk_size - 1
+    chunk_size = max(1, chunk_size)
+    overlap = max(0, min(overlap, chunk_size - 1))
+    chunks = []
+    current = ''
+    for paragraph in re.split(r'\n\s*\n|\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(current) + len(paragraph) + 1 <= chunk_size:
+            current = f"{current}\n{paragraph}" if current else paragraph
+            continue
+        if current:
+            chunks.append(current)
+            current = ''
+        while len(paragraph) > chunk_size:
+            chunks.append(paragraph[:chunk_size])
+            paragraph = paragraph[chunk_size - overlap:]
+        current = paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class ChunkIndex:
+    """知识库索引基类，保存文本块并提供兜底的文档开头文本块"""
+
+    def __init__(self, chunk_size=500):
+        self.chunk_size = chunk_size
+        self.chunks = []          # [{'source': 文件名, 'text': 文本块}]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def leading_chunks(self, limit=5):
+        """每篇文档的开头文本块，用于查询与任何文本块都不匹配（如“总结一下”）时兜底"""
+        with self._lock:
+            seen = set()
+            result = []
+            for chunk in self.chunks:
+                if chunk['source'] in seen:
+                    continue
+                seen.add(chunk['source'])
+                result.append(dict(chunk, score=0.0))
+                if len(result) >= limit:
+                    break
+            return result
+
+
+class BM25Index(ChunkIndex):
+    """支持增量添加文档的 BM25 倒排索引"""
+
+    def __init__(self, k1=1.5, b=0.75, chunk_size=500):
+        super().__init__(chunk_size)
+        self.k1 = k1
+        self.b = b
+        self.chunk_lengths = []   # 每个文本块的词数
+        self.postings = {}        # 词 -> {文本块序号: 词频}
+        self.total_length = 0
+
+    def add_document(self, source, text):
+        """切分并索引一篇文档，返回新增的文本块数"""
+        new_chunks = split_into_chunks(text, self.chunk_size)
+        tokenized = [tokenize(chunk) for chunk in new_chunks]
+        with self._lock:
+            for chunk, tokens in zip(new_chunks, tokenized):
+                chunk_id = len(self.chunks)
+                self.chunks.append({'source': source, 'text': chunk})
+                self.chunk_lengths.append(len(tokens))
+                self.total_length += len(tokens)
+                term_freqs = {}
+                for token in tokens:
+                    term_freqs[token] = term_freqs.get(token, 0) + 1
+                for token, freq in term_freqs.items():
+                    self.postings.setdefault(token, {})[chunk_id] = freq
+        return len(new_chunks)
+
+    def search(self, query, top_k=5):
+        """返回与查询最相关的文本块列表（按得分降序），每项含 source、text、score"""
+        return _bm25_search([self], query, top_k)
+
+    def corpus_stats(self, terms):
+        """返回 (文本块数, 总词数, {词: 包含该词的文本块数})，用于跨索引计算全局 IDF"""
+        with self._lock:
+            return len(self.chunks), self.total_length, {term: len(self.postings.get(term, ())) for term in terms}
+
+    def score_chunks(self, terms, idf, avg_length):
+        """按给定的全局 IDF 和平均长度为包含查询词的文本块打分，返回 [(得分, 文本块)]"""
+        with self._lock:
+            scores = {}
+            for term in terms:
+                for chunk_id, freq in self.postings.get(term, {}).items():
+                    norm = self.k1 * (1 - self.b + self.b * self.chunk_lengths[chunk_id] / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            return [(score, self.chunks[chunk_id]) for chunk_id, score in scores.items()]
+
+    def clear(self):
+        with self._lock:
+            self.chunks = []
+            self.chunk_lengths = []
+            self.postings = {}
+            self.total_length = 0
+
+
+class VectorIndex(ChunkIndex):
+    """字符 n-gram 哈希向量检索
+
+    HashingVectorizer 无需拟合词表，新文档的向量直接追加为新的矩阵块，不必重建已有向量；
+    检索前把积累的矩阵块合并为一个 CSR 稀疏矩阵，用一次矩阵乘法算出全部文本块的余弦相似度。
+    """
+
+    def __init__(self, chunk_size=500, ngram_range=(2, 3), n_features=2 ** 18):
+        super().__init__(chunk_size)
+        # scikit-learn 导入较慢，仅在启用向量检索时加载
+        from sklearn.feature_extraction.text import HashingVectorizer
+        # 中文没有空格分词，直接使用字符 n-gram；向量已做 L2 归一化，点积即余弦相似度
+        self.vectorizer = HashingVectorizer(
+            analyzer='char',
+            ngram_range=ngram_range,
+            n_features=n_features,
+            alternate_sign=False,
+            norm='l2',
+            lowercase=True
+        )
+        self._blocks = []         # 尚未合并的文本块向量矩阵
+        self._matrix = None       # 已合并的 CSR 矩阵，行与 self.chunks 一一对应
+
+    def add_document(self, source, text):
+        """切分并索引一篇文档，返回新增的文本块数"""
+        new_chunks = split_into_chunks(text, self.chunk_size)
+        if not new_chunks:
+            return 0
+        vectors = self.vectorizer.transform(new_chunks)
+        with self._lock:
+            self.chunks.extend({'source': source, 'text': chunk} for chunk in new_chunks)
+            self._blocks.append(vectors)
+        return len(new_chunks)
+
+    def _compact(self):
+        """把新追加的矩阵块合并进检索矩阵（需持有锁）"""
+        if not self._blocks:
+            return
+        from scipy.sparse import vstack
+        blocks = [self._matrix] if self._matrix is not None else []
+        self._matrix = vstack(blocks + self._blocks, format='csr')
+        self._blocks = []
+
+    def search(self, query, top_k=5):
+        """返回与查询余弦相似度最高的文本块列表（按得分降序），每项含 source、text、score"""
+        query = query.strip()
+        if not query:
+            return []
+        query_vector = self.vectorizer.transform([query])
+        with self._lock:
+            self._compact()
+            if self._matrix is None:
+                return []
+            scores = (self._matrix @ query_vector.T).toarray().ravel()
+            k = min(top_k, scores.shape[0])
+            if k <= 0:
+                return []
+            # argpartition 取前 k 个再排序，避免对全部文本块排序
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [dict(self.chunks[i], score=float(scores[i])) for i in top if scores[i] > 0]
+
+    def clear(self):
+        with self._lock:
+            self.chunks = []
+            self._blocks = []
+            self._matrix = None
+
+
+def _bm25_search(indexes, query, top_k):
+    """在多个 BM25 索引上按合并后的全局统计量检索，结果与在一个大索引上检索一致"""
+    query_terms = set(tokenize(query))
+    if not query_terms:
+        return []
+    total = 0
+    total_length = 0
+    doc_freqs = dict.fromkeys(query_terms, 0)
+    for index in indexes:
+        chunks, length, freqs = index.corpus_stats(query_terms)
+        total += chunks
+        total_length += length
+        for term, freq in freqs.items():
+            doc_freqs[term] += freq
+    if total == 0:
+        return []
+    avg_length = total_length / total or 1.0
+    terms = [term for term, freq in doc_freqs.items() if freq]
+    idf = {term: math.log(1 + (total - doc_freqs[term] + 0.5) / (doc_freqs[term] + 0.5)) for term in terms}
+
+    scored = []
+    for index in indexes:
+        scored.extend(index.score_chunks(terms, idf, avg_length))
+    ranked = heapq.nlargest(top_k, scored, key=lambda item: item[0])
+    return [dict(chunk, score=score) for score, chunk in ranked]
+
+
+def search_indexes(indexes, query, top_k=5):
+    """在多个索引上联合检索，返回得分最高的 top_k 个文本块"""
+    bm25_indexes = [index for index in indexes if isinstance(index, BM25Index)]
+    results = _bm25_search(bm25_indexes, query, top_k) if bm25_indexes else []
+    # 向量索引的余弦相似度与其他文本块无关，直接合并排序
+    for index in indexes:
+        if not isinstance(index, BM25Index):
+            results.extend(index.search(query, top_k))
+    results.sort(key=lambda chunk: chunk['score'], reverse=True)
+    return results[:top_k]
+
+
+def create_index(kind='bm25', chunk_size=500):
+    """按检索方式创建知识库索引：bm25（关键词）或 vector（字符 n-gram 向量）"""
+    if kind == 'vector':
+        return VectorIndex(chunk_size=chunk_size)
+    return BM25Index(chunk_size=chunk_size)
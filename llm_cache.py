@@ -0,0 +1,148 @@
+"""大模型响应缓存
+
+以模型名、调用参数和消息列表的规范化哈希作为键，缓存分两级：
+内存中的 LRU 缓存和基于 SQLite 的磁盘缓存，两级都有容量和过期时间限制。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(model, parameters, messages):
+    """根据模型、参数和消息计算规范化的缓存键"""
+    canonical = json.dumps(
+        {"model": model, "parameters": parameters, "messages": messages},
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """内存 LRU + SQLite 磁盘两级缓存"""
+
+    def __init__(self, db_path=None, memory_max_entries=256, disk_max_entries=5000, ttl=7 * 24 * 3600):
+        self.memory_max_entries = memory_max_entries
+        self.disk_max_entries = disk_max_entries
+        self.ttl = ttl
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats_counter = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0
+        }
+
+        self._db = None
+        if db_path:
+            db_dir = os.path.dirname(db_path)
+            if db_dir and not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)')
+            self._db.commit()
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key):
+        """读取缓存，未命中或已过期时返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.stats_counter['memory_hits'] += 1
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value, created_at FROM llm_cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    if not self._expired(row[1], now):
+                        self._db.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                        self._db.commit()
+                        value = json.loads(row[0])
+                        self._remember(key, row[1], value)
+                        self.stats_counter['disk_hits'] += 1
+                        return value
+                    self._db.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                    self._db.commit()
+
+            self.stats_counter['misses'] += 1
+            return None
+
+    def set(self, key, value):
+        """写入缓存（value 需可 JSON 序列化）"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            self.stats_counter['stores'] += 1
+
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(value, ensure_ascii=False), now, now)
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def _remember(self, key, created_at, value):
+        """写入内存层，超出容量时淘汰最久未使用的条目"""
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_entries:
+            self._memory.popitem(last=False)
+            self.stats_counter['evictions'] += 1
+
+    def _evict_disk(self, now):
+        """清理磁盘层中过期和超出容量的条目"""
+        if self.ttl is not None:
+            cursor = self._db.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+            self.stats_counter['evictions'] += cursor.rowcount
+        count = self._db.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        if count > self.disk_max_entries:
+            cursor = self._db.execute(
+                'DELETE FROM llm_cache WHERE key IN ('
+                'SELECT key FROM llm_cache ORDER BY accessed_at ASC LIMIT ?)',
+                (count - self.disk_max_entries,)
+            )
+            self.stats_counter['evictions'] += cursor.rowcount
+
+    def clear(self):
+        """清空所有缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM llm_cache')
+                self._db.commit()
+
+    def stats(self):
+        """返回命中率等统计信息"""
+        with self._lock:
+            stats = dict(self.stats_counter)
+            stats['memory_entries'] = len(self._memory)
+            if self._db is not None:
+                stats['disk_entries'] = self._db.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        hits = stats['memory_hits'] + stats['disk_hits']
+        total = hits + stats['misses']
+        stats['hit_rate'] = hits / total if total else 0.0
+        return stats
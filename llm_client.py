@@ -0,0 +1,365 @@
+"""阿里云大模型（DashScope）调用客户端
+
+所有调用大模型的地方共用一个带连接池的 requests.Session，
+避免每次请求都重新建立 TLS 连接，并为每次调用设置连接/读取超时。
+每次调用的耗时、token 用量和错误都会记录到 metrics 模块的 Prometheus 指标中。
+上游调用受自适应并发限制和熔断器保护；调用方标记 idempotent=True（重复调用没有副作用）时，
+429/5xx/网络错误会按指数退避重试，默认不重试。
+"""
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from llm_cache import make_cache_key
+from metrics import (
+    LLM_ERRORS, LLM_INPUT_TOKENS, LLM_LATENCY, LLM_OUTPUT_TOKENS, LLM_PROMPT_CHARS, LLM_REQUESTS, LLM_RETRIES
+)
+from resilience import AdaptiveLimiter, CircuitBreaker, backoff_delay
+from singleflight import SingleFlight
+
+# 记录当前线程本次请求中建立新连接（含 TLS 握手）的耗时
+_connect_timing = threading.local()
+
+
+class _ConnectTimingMixin:
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = getattr(_connect_timing, 'seconds', 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPConnection(_ConnectTimingMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_ConnectTimingMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """记录建立连接耗时的连接池适配器（复用长连接时耗时为 0）"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool
+        }
+
+
+class LLMError(Exception):
+    """大模型调用失败"""
+
+    def __init__(self, message, status_code=None, body='', reason=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+        # 用于错误计数的分类：HTTP 状态码，或 network / stream / bad_response / circuit_open / queue_timeout
+        self.reason = reason or (str(status_code) if status_code else 'network')
+
+    @property
+    def retryable(self):
+        """限流、服务端错误和网络错误可以重试，也视为上游过载信号"""
+        if self.status_code:
+            return self.status_code == 429 or self.status_code >= 500
+        return self.reason == 'network'
+
+    @property
+    def unavailable(self):
+        """上游限流或本地熔断/排队超时，调用方应提示稍后重试"""
+        return self.status_code == 429 or self.reason in ('circuit_open', 'queue_timeout')
+
+
+def _record_usage(result, labels):
+    """记录 DashScope 返回的 usage 信息"""
+    usage = result.get('usage') or {}
+    if usage.get('input_tokens'):
+        LLM_INPUT_TOKENS.labels(**labels).inc(usage['input_tokens'])
+    if usage.get('output_tokens'):
+        LLM_OUTPUT_TOKENS.labels(**labels).inc(usage['output_tokens'])
+
+
+def _record_prompt_chars(payload, labels):
+    """记录提示词字符数，每次调用记录一次，不随重试重复记录"""
+    LLM_PROMPT_CHARS.labels(**labels).observe(
+        sum(len(m.get('content') or '') for m in payload['input']['messages'])
+    )
+
+
+class DashScopeClient:
+    """DashScope 文本生成接口客户端"""
+
+    def __init__(self, api_key, api_url, pool_size=10, connect_timeout=5, read_timeout=120, cache=None,
+                 limiter=None, breaker=None, max_retries=2, queue_timeout=30):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        # 自适应并发限制和熔断器
+        self.limiter = limiter or AdaptiveLimiter(max_limit=pool_size)
+        self.breaker = breaker or CircuitBreaker()
+        # 可选的响应缓存（LLMCache），仅在调用方传入 use_cache=True 时使用
+        self.cache = cache
+        # 合并并发的相同请求，只向上游发起一次调用
+        self.singleflight = SingleFlight()
+
+        # 共享连接池，保持长连接
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def build_headers(self):
+        """构造请求头"""
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+    def build_payload(self, messages, model='qwen-max', **parameters):
+        """构造请求体"""
+        return {
+            "model": model,
+            "input": {
+                "messages": messages
+            },
+            "parameters": parameters
+        }
+
+    def post(self, payload, timeout=None, extra_headers=None, labels=None, **kwargs):
+        """发送请求并返回原始响应，HTTP 错误以 LLMError 抛出
+
+        传入 labels 时记录建立连接耗时。
+        """
+        headers = self.build_headers()
+        if extra_headers:
+            headers.update(extra_headers)
+        _connect_timing.seconds = 0.0
+        try:
+            response = self.session.post(
+                self.api_url,
+                headers=headers,
+                json=payload,
+                timeout=timeout or (self.connect_timeout, self.read_timeout),
+                **kwargs
+            )
+        except requests.RequestException as e:
+            raise LLMError(f"请求大模型失败: {str(e)}") from e
+        finally:
+            if labels is not None:
+                LLM_LATENCY.labels(phase='connect', **labels).observe(_connect_timing.seconds)
+
+        if response.status_code != 200:
+            raise LLMError(
+                f"HTTP {response.status_code} - {response.text}",
+                status_code=response.status_code,
+                body=response.text
+            )
+        return response
+
+    def acquire_slot(self, labels=None):
+        """经过熔断器和自适应并发限制，获取一个上游调用配额
+
+        传入 labels 时记录本次尝试等待配额的耗时，重试时每次尝试各记录一次，不含之前的尝试和退避时间。
+        """
+        if not self.breaker.allow():
+            raise LLMError('大模型服务暂时不可用（熔断中），请稍后重试', reason='circuit_open')
+        wait_started = time.perf_counter()
+        if not self.limiter.acquire(timeout=self.queue_timeout):
+            self.breaker.cancel()
+            raise LLMError('等待大模型并发配额超时，请稍后重试', reason='queue_timeout')
+        if labels is not None:
+            LLM_LATENCY.labels(phase='queue', **labels).observe(time.perf_counter() - wait_started)
+
+    def release_slot(self, latency, error=None):
+        """归还配额，并把本次结果反馈给并发限制和熔断器"""
+        overloaded = error is not None and error.retryable
+        self.limiter.release(latency, overloaded=overloaded)
+        if overloaded:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def call_with_retries(self, func, retries, labels):
+        """调用 func()，对可重试的错误按带抖动的指数退避重试"""
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except LLMError as e:
+                if attempt >= retries or not e.retryable:
+                    raise
+                LLM_RETRIES.labels(reason=e.reason, **labels).inc()
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+
+    def send(self, payload, timeout=None, labels=None):
+        """在配额保护下发送一次非流式请求并返回 JSON 结果"""
+        self.acquire_slot(labels)
+        sent_at = time.perf_counter()
+        latency = None
+        error = None
+        try:
+            response = self.post(payload, timeout=timeout, labels=labels)
+            latency = response.elapsed.total_seconds()
+            try:
+                return response.json()
+            except ValueError as e:
+                raise LLMError(f"大模型返回了无法解析的响应: {str(e)}", body=response.text, reason='bad_response') from e
+        except LLMError as e:
+            error = e
+            raise
+        finally:
+            self.release_slot(latency if latency is not None else time.perf_counter() - sent_at, error)
+
+    def request(self, messages, model='qwen-max', timeout=None, use_cache=False, coalesce=True,
+                endpoint='default', idempotent=False, **parameters):
+        """调用模型并返回完整的 JSON 结果，idempotent=True 时对可重试的错误重试"""
+        started = time.perf_counter()
+        labels = {'endpoint': endpoint, 'model': model}
+        outcome = 'ok'
+        try:
+            request_key = make_cache_key(model, parameters, messages)
+            use_cache = use_cache and self.cache is not None
+            if use_cache:
+                cached = self.cache.get(request_key)
+                if cached is not None:
+                    outcome = 'cache_hit'
+                    return cached
+
+            executed = []
+
+            def call_upstream():
+                executed.append(True)
+                payload = self.build_payload(messages, model, **parameters)
+                _record_prompt_chars(payload, labels)
+                result = self.call_with_retries(
+                    lambda: self.send(payload, timeout=timeout, labels=labels),
+                    self.max_retries if idempotent else 0,
+                    labels
+                )
+                _record_usage(result, labels)
+                if use_cache:
+                    self.cache.set(request_key, result)
+                return result
+
+            if coalesce:
+                result = self.singleflight.do(request_key, call_upstream)
+            else:
+                result = call_upstream()
+            if not executed:
+                outcome = 'coalesced'
+            return result
+        except LLMError as e:
+            outcome = 'error'
+            LLM_ERRORS.labels(reason=e.reason, **labels).inc()
+            raise
+        finally:
+            LLM_REQUESTS.labels(outcome=outcome, **labels).inc()
+            LLM_LATENCY.labels(phase='total', **labels).observe(time.perf_counter() - started)
+
+    def generate(self, messages, model='qwen-max', timeout=None, use_cache=False, coalesce=True,
+                 endpoint='default', idempotent=False, **parameters):
+        """调用模型并返回回复文本"""
+        result = self.request(messages, model, timeout=timeout, use_cache=use_cache, coalesce=coalesce,
+                              endpoint=endpoint, idempotent=idempotent, **parameters)
+        return result.get('output', {}).get('text', '')
+
+    def stream(self, messages, model='qwen-max', timeout=None, endpoint='default', idempotent=False, **parameters):
+        """以增量输出（SSE）方式调用模型，逐段产出回复文本
+
+        idempotent=True 时只在建立流之前重试；已开始输出后出错不再重试，避免重复内容。
+        """
+        started = time.perf_counter()
+        labels = {'endpoint': endpoint, 'model': model}
+        outcome = 'ok'
+        parameters['incremental_output'] = True
+        payload = self.build_payload(messages, model, **parameters)
+        _record_prompt_chars(payload, labels)
+
+        def open_stream():
+            self.acquire_slot(labels)
+            sent_at = time.perf_counter()
+            try:
+                return self.post(
+                    payload,
+                    timeout=timeout,
+                    extra_headers={"Accept": "text/event-stream", "X-DashScope-SSE": "enable"},
+                    labels=labels,
+                    stream=True
+                )
+            except LLMError as e:
+                self.release_slot(time.perf_counter() - sent_at, e)
+                raise
+
+        try:
+            response = self.call_with_retries(
+                open_stream, self.max_retries if idempotent else 0, labels
+            )
+            stream_error = None
+            try:
+                first_token = True
+                last_data = {}
+                for raw_line in response.iter_lines():
+                    # SSE 响应头通常不带 charset，按 UTF-8 自行解码
+                    line = raw_line.decode('utf-8')
+                    if not line.startswith('data:'):
+                        continue
+                    try:
+                        data = json.loads(line[len('data:'):])
+                    except ValueError as e:
+                        # 截断或格式错误的事件按大模型错误处理，调用方可以返回错误事件并计入错误指标
+                        raise LLMError(f"大模型返回了无法解析的流式事件: {str(e)}", body=line, reason='bad_response') from e
+                    if 'output' not in data:
+                        # 流中途返回的错误信息
+                        raise LLMError(
+                            f"{data.get('code', '')} - {data.get('message', '')}",
+                            status_code=data.get('status_code'),
+                            body=line,
+                            reason='stream'
+                        )
+                    last_data = data
+                    text = data['output'].get('text', '')
+                    if text:
+                        if first_token:
+                            LLM_LATENCY.labels(phase='first_token', **labels).observe(time.perf_counter() - started)
+                            first_token = False
+                        yield text
+                # 增量输出模式下最后一个事件的 usage 为累计值
+                _record_usage(last_data, labels)
+            except LLMError as e:
+                stream_error = e
+                raise
+            except requests.RequestException as e:
+                stream_error = LLMError(f"读取大模型流式响应失败: {str(e)}", reason='stream')
+                raise stream_error from e
+            finally:
+                response.close()
+                # 以收到响应头的时间作为延迟信号，流式输出时长取决于回复长度
+                self.release_slot(response.elapsed.total_seconds(), stream_error)
+        except GeneratorExit:
+            # 调用方提前停止读取（如浏览器断开连接）
+            outcome = 'cancelled'
+            raise
+        except LLMError as e:
+            outcome = 'error'
+            LLM_ERRORS.labels(reason=e.reason, **labels).inc()
+            raise
+        finally:
+            LLM_REQUESTS.labels(outcome=outcome, **labels).inc()
+            LLM_LATENCY.labels(phase='total', **labels).observe(time.perf_counter() - started)
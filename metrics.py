@@ -0,0 +1,77 @@
+"""Prometheus 监控指标
+
+大模型调用的耗时、token 用量和错误计数，以及缓存等组件的运行统计，
+统一通过 /metrics 接口以 Prometheus 文本格式暴露。
+"""
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+LLM_REQUESTS = Counter(
+    'llm_requests',
+    '大模型调用次数（outcome: ok / cache_hit / coalesced / error / cancelled）',
+    ['endpoint', 'model', 'outcome']
+)
+LLM_LATENCY = Histogram(
+    'llm_request_duration_seconds',
+    '大模型调用各阶段耗时（phase: queue / connect / first_token / total）',
+    ['endpoint', 'model', 'phase'],
+    buckets=LATENCY_BUCKETS
+)
+LLM_PROMPT_CHARS = Histogram(
+    'llm_prompt_chars',
+    '发送给大模型的提示词字符数',
+    ['endpoint', 'model'],
+    buckets=(500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+)
+LLM_INPUT_TOKENS = Counter(
+    'llm_input_tokens',
+    'DashScope 返回的输入 token 数',
+    ['endpoint', 'model']
+)
+LLM_OUTPUT_TOKENS = Counter(
+    'llm_output_tokens',
+    'DashScope 返回的输出 token 数',
+    ['endpoint', 'model']
+)
+LLM_ERRORS = Counter(
+    'llm_errors',
+    '大模型调用错误次数（reason 为 HTTP 状态码或 network / stream / circuit_open / queue_timeout）',
+    ['endpoint', 'model', 'reason']
+)
+LLM_RETRIES = Counter(
+    'llm_retries',
+    '大模型调用重试次数',
+    ['endpoint', 'model', 'reason']
+)
+
+
+class StatsCollector:
+    """抓取时调用 stats_func()，把返回字典中的数值作为 gauge 输出"""
+
+    def __init__(self, prefix, description, stats_func):
+        self.prefix = prefix
+        self.description = description
+        self.stats_func = stats_func
+
+    def collect(self):
+        try:
+            stats = self.stats_func()
+        except Exception as e:
+            print(f"采集 {self.prefix} 指标失败: {str(e)}")
+            return
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            yield GaugeMetricFamily(f"{self.prefix}_{key}", f"{self.description}: {key}", value=value)
+
+
+def register_stats(prefix, description, stats_func):
+    """注册一个按需采集的统计来源"""
+    REGISTRY.register(StatsCollector(prefix, description, stats_func))
+
+
+def render_metrics():
+    """返回 (内容, Content-Type)"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,261 @@
+"""本地 DashScope 模拟服务
+
+实现 app.py 使用的文本生成接口（普通响应和 SSE 增量输出），用于离线测试和压测，
+不消耗 API 额度。延迟分布、错误率和固定回复均可配置。
+
+启动后在 .env 中设置：
+API_URL=http://127.0.0.1:8090/api/v1/services/aigc/text-generation/generation
+
+用法：
+python mock_dashscope.py --port 8090 --latency-mean 0.8 --latency-jitter 0.3 --error-rate 0.02
+"""
+import argparse
+import json
+import random
+import re
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+
+GENERATION_PATH = '/api/v1/services/aigc/text-generation/generation'
+
+DEFAULT_CONFIG = {
+    # 延迟分布：fixed / uniform / lognormal，单位秒
+    'latency_dist': 'uniform',
+    'latency_mean': 0.5,
+    'latency_jitter': 0.2,
+    # 返回 429 限流和 500 错误的概率
+    'throttle_rate': 0.0,
+    'error_rate': 0.0,
+    # 流式输出时每段的字符数和间隔
+    'stream_chunk_chars': 8,
+    'stream_chunk_delay': 0.02,
+    # 固定回复：提示词包含某子串时返回对应文本（优先于内置回复）
+    'replies': {},
+    'seed': None
+}
+
+VISUALIZATION_CODE = '''```python
+import matplotlib.pyplot as plt
+
+def plot1(df):
+    # 第一个数值列的分布
+    numeric = df.select_dtypes(include='number')
+    if numeric.shape[1] > 0:
+        numeric.iloc[:, 0].dropna().plot(kind='hist', bins=20)
+    plt.title("数值分布")
+
+def plot2(df):
+    # 第一个分类列的频数
+    categorical = df.select_dtypes(exclude='number')
+    if categorical.shape[1] > 0:
+        categorical.iloc[:, 0].value_counts().head(10).plot(kind='bar')
+    plt.title("类别频数")
+
+def plot3(df):
+    # 各数值列的箱线图
+    numeric = df.select_dtypes(include='number')
+    if numeric.shape[1] > 0:
+        numeric.plot(kind='box')
+    plt.title("箱线图")
+
+def plot4(df):
+    # 前两个数值列的散点图
+    numeric = df.select_dtypes(include='number').dropna()
+    if numeric.shape[1] > 1:
+        plt.scatter(numeric.iloc[:, 0], numeric.iloc[:, 1])
+    plt.title("散点图")
+
+def plot5(df):
+    # 各列缺失值数量
+    df.isnull().sum().plot(kind='bar')
+    plt.title("缺失值统计")
+```'''
+
+ANALYSIS_REPORT = """1. 数据概述
+本数据由本地模拟服务分析，仅用于测试。
+
+2. 关键洞察和发现
+数据结构完整，可进行进一步分析。
+
+3. 潜在问题点
+未发现明显的数据质量问题。
+
+4. 具体建议
+建议结合业务场景进行深入分析。
+
+5. 本数据的价值以及更远的展望
+可作为后续建模与决策的基础数据。"""
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数，用于返回 usage 字段"""
+    return max(1, len(text) // 2)
+
+
+def build_reply(messages, config):
+    """根据提示词返回与 app.py 解析逻辑匹配的固定回复"""
+    prompt = messages[-1]['content'] if messages else ''
+    full_text = '\n'.join(m.get('content', '') for m in messages)
+
+    for keyword, reply in config['replies'].items():
+        if keyword in full_text:
+            return reply
+
+    # Excel AI处理：原样返回预览数据，符合 "=== 处理后的数据 ===" 格式
+    if '=== 处理后的数据 ===' in prompt:
+        match = re.search(r'数据预览\(前20行\):\n(.*?)\n\n用户指令是', prompt, re.DOTALL)
+        rows = []
+        if match:
+            try:
+                rows = json.loads(match.group(1))
+            except ValueError:
+                rows = []
+        return (
+            "=== AI处理说明 ===\n模拟服务未修改数据，原样返回预览数据。\n\n"
+            "=== 处理后的数据 ===\n" + json.dumps(rows, ensure_ascii=False)
+        )
+
+    # 可视化代码：返回 plot1~plot5 的 python 代码块
+    if 'plot1' in prompt and '可视化' in prompt:
+        return VISUALIZATION_CODE
+
+    # 数据分析报告
+    if '数据分析报告' in prompt:
+        return ANALYSIS_REPORT
+
+    return f"（模拟回复）已收到你的消息：{prompt[:200]}"
+
+
+def create_app(config=None):
+    """创建模拟服务应用"""
+    settings = dict(DEFAULT_CONFIG)
+    settings.update(config or {})
+    rng = random.Random(settings['seed'])
+    mock_app = Flask(__name__)
+    mock_app.config['MOCK_SETTINGS'] = settings
+    mock_app.config['MOCK_STATS'] = {'requests': 0, 'throttled': 0, 'errors': 0}
+
+    def sample_latency():
+        mean = settings['latency_mean']
+        jitter = settings['latency_jitter']
+        if settings['latency_dist'] == 'fixed':
+            return mean
+        if settings['latency_dist'] == 'lognormal':
+            # 以 mean 为中位数、jitter 为形状参数的长尾分布
+            return rng.lognormvariate(0, jitter) * mean if mean > 0 else 0
+        return max(0.0, rng.uniform(mean - jitter, mean + jitter))
+
+    def error_response(status_code, code, message):
+        return jsonify({
+            'code': code,
+            'message': message,
+            'request_id': str(uuid.uuid4())
+        }), status_code
+
+    @mock_app.route(GENERATION_PATH, methods=['POST'])
+    def generation():
+        stats = mock_app.config['MOCK_STATS']
+        stats['requests'] += 1
+
+        data = request.get_json(silent=True) or {}
+        messages = data.get('input', {}).get('messages', [])
+        parameters = data.get('parameters', {})
+        if not messages:
+            return error_response(400, 'InvalidParameter', 'input.messages is required')
+
+        roll = rng.random()
+        if roll < settings['throttle_rate']:
+            stats['throttled'] += 1
+            return error_response(429, 'Throttling.RateQuota', 'Requests rate limit exceeded')
+        if roll < settings['throttle_rate'] + settings['error_rate']:
+            stats['errors'] += 1
+            return error_response(500, 'InternalError', 'Mock internal error')
+
+        reply = build_reply(messages, settings)
+        input_tokens = sum(estimate_tokens(m.get('content', '')) for m in messages)
+        request_id = str(uuid.uuid4())
+
+        stream = request.headers.get('X-DashScope-SSE') == 'enable'
+        if not stream:
+            time.sleep(sample_latency())
+            return jsonify({
+                'output': {'text': reply, 'finish_reason': 'stop'},
+                'usage': {
+                    'input_tokens': input_tokens,
+                    'output_tokens': estimate_tokens(reply),
+                    'total_tokens': input_tokens + estimate_tokens(reply)
+                },
+                'request_id': request_id
+            })
+
+        incremental = parameters.get('incremental_output', False)
+        first_token_delay = sample_latency()
+
+        def generate():
+            time.sleep(first_token_delay)
+            size = settings['stream_chunk_chars']
+            chunks = [reply[i:i + size] for i in range(0, len(reply), size)] or ['']
+            sent = ''
+            for index, chunk in enumerate(chunks):
+                sent += chunk
+                last = index == len(chunks) - 1
+                body = {
+                    'output': {
+                        'text': chunk if incremental else sent,
+                        'finish_reason': 'stop' if last else 'null'
+                    },
+                    'usage': {
+                        'input_tokens': input_tokens,
+                        'output_tokens': estimate_tokens(sent),
+                        'total_tokens': input_tokens + estimate_tokens(sent)
+                    },
+                    'request_id': request_id
+                }
+                yield f"id:{index + 1}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(body, ensure_ascii=False)}\n\n"
+                if not last:
+                    time.sleep(settings['stream_chunk_delay'])
+
+        return Response(generate(), mimetype='text/event-stream')
+
+    @mock_app.route('/mock/stats', methods=['GET'])
+    def mock_stats():
+        return jsonify(mock_app.config['MOCK_STATS'])
+
+    return mock_app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='本地 DashScope 模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'lognormal'], default=DEFAULT_CONFIG['latency_dist'])
+    parser.add_argument('--latency-mean', type=float, default=DEFAULT_CONFIG['latency_mean'])
+    parser.add_argument('--latency-jitter', type=float, default=DEFAULT_CONFIG['latency_jitter'])
+    parser.add_argument('--throttle-rate', type=float, default=DEFAULT_CONFIG['throttle_rate'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_CONFIG['error_rate'])
+    parser.add_argument('--stream-chunk-chars', type=int, default=DEFAULT_CONFIG['stream_chunk_chars'])
+    parser.add_argument('--stream-chunk-delay', type=float, default=DEFAULT_CONFIG['stream_chunk_delay'])
+    parser.add_argument('--replies', help='固定回复 JSON 文件，格式为 {"提示词子串": "回复文本"}')
+    parser.add_argument('--seed', type=int, help='随机种子，便于复现延迟和错误序列')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = {
+        'latency_dist': args.latency_dist,
+        'latency_mean': args.latency_mean,
+        'latency_jitter': args.latency_jitter,
+        'throttle_rate': args.throttle_rate,
+        'error_rate': args.error_rate,
+        'stream_chunk_chars': args.stream_chunk_chars,
+        'stream_chunk_delay': args.stream_chunk_delay,
+        'seed': args.seed
+    }
+    if args.replies:
+        with open(args.replies, 'r', encoding='utf-8') as f:
+            config['replies'] = json.load(f)
+    print(f"DashScope 模拟服务: http://{args.host}:{args.port}{GENERATION_PATH}")
+    create_app(config).run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,183 @@
+"""PDF 分页并行文本提取
+
+把 PDF 的页码区间分配到进程池中并行提取文本，按页码顺序逐页产出结果。
+每页设置超时，异常页面只返回空文本，不会卡住整个上传请求。
+子进程卡死或崩溃时换用新的进程池，旧进程池中其他上传的任务继续执行完，宽限时间过后终止仍未退出的子进程；
+因进程池被换下而失败的任务在新进程池中重新提交一次。
+页数较少的 PDF 直接在当前进程中提取，避免进程池调度开销。
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import PyPDF2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PageTimeout(Exception):
+    """单页提取超时"""
+
+
+def _on_alarm(signum, frame):
+    raise PageTimeout()
+
+
+def _extract_page(page, page_timeout):
+    """提取单页文本，返回 (文本, 是否超时)；支持 SIGALRM 的平台上按 page_timeout 中断"""
+    use_alarm = page_timeout and hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, page_timeout)
+    try:
+        return page.extract_text() or '', False
+    except PageTimeout:
+        return '', True
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def _extract_range(filepath, start, end, page_timeout):
+    """在子进程中提取 [start, end) 页，返回 [(文本, 是否超时), ...]"""
+    reader = PyPDF2.PdfReader(filepath)
+    return [_extract_page(reader.pages[i], page_timeout) for i in range(start, end)]
+
+
+def _mp_context():
+    """避免在多线程的 Web 进程中直接 fork：优先使用 forkserver 并只预加载本模块，
+    这样子进程不会重新导入 app.py；不支持 forkserver 的平台（Windows）使用 spawn。"""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+        return _pool
+
+
+def _retire_pool(pool, grace):
+    """子进程崩溃或卡死后换下进程池，下次使用时重建
+
+    不取消其他调用方在旧进程池中的任务，等它们在 grace 秒内执行完，之后终止仍未退出的子进程
+    （shutdown(wait=False) 本身不会结束卡死的子进程）。同一个进程池只换下一次。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not pool:
+            return
+        _pool = None
+    # ProcessPoolExecutor 没有公开子进程列表，只能读取 _processes
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False)
+
+    def reap():
+        deadline = time.monotonic() + grace
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+
+    threading.Thread(target=reap, name='pdf-pool-reaper', daemon=True).start()
+
+
+def _submit(workers, *args):
+    """把区间提交到当前进程池，返回 (进程池, future)；进程池刚被换下时重建后再提交"""
+    for attempt in range(2):
+        pool = _get_pool(workers)
+        try:
+            return pool, pool.submit(_extract_range, *args)
+        except (RuntimeError, BrokenProcessPool):
+            if attempt:
+                raise
+            _retire_pool(pool, 0)
+
+
+def iter_pdf_pages(filepath, workers=None, pages_per_task=8, page_timeout=10, parallel_min_pages=16, stats=None):
+    """按页码顺序逐页产出文本
+
+    stats 字典会被填入 pages（总页数）、extracted_pages、timed_out_pages、seconds、pages_per_second。
+    """
+    started = time.perf_counter()
+    stats = stats if stats is not None else {}
+    reader = PyPDF2.PdfReader(filepath)
+    num_pages = len(reader.pages)
+    stats.update({'pages': num_pages, 'extracted_pages': 0, 'timed_out_pages': 0, 'parallel': False})
+    workers = workers or min(4, os.cpu_count() or 1)
+
+    try:
+        if num_pages < parallel_min_pages or workers <= 1:
+            for page in reader.pages:
+                text, timed_out = _extract_page(page, page_timeout)
+                stats['timed_out_pages'] += timed_out
+                stats['extracted_pages'] += 1
+                yield text
+            return
+
+        stats['parallel'] = True
+        # 子进程内每页有超时，这里再为整个区间留出余量，防止子进程本身卡死；
+        # 换下进程池时给其他调用方的任务留出同样的时间
+        grace = page_timeout * pages_per_task + 30
+        ranges = [(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)]
+        submitted = [_submit(workers, filepath, start, end, page_timeout) for start, end in ranges]
+        attempts = [1] * len(ranges)
+
+        def resubmit(index):
+            start, end = ranges[index]
+            submitted[index][1].cancel()
+            submitted[index] = _submit(workers, filepath, start, end, page_timeout)
+            attempts[index] += 1
+
+        try:
+            for index, (start, end) in enumerate(ranges):
+                results = None
+                while True:
+                    pool, future = submitted[index]
+                    try:
+                        results = future.result(timeout=page_timeout * (end - start) + 30)
+                        break
+                    except (FutureTimeoutError, BrokenProcessPool, CancelledError) as e:
+                        # 超时前进程池已被其他调用方换下，说明本任务排在卡死的子进程后面，而不是自己卡死
+                        retired = _pool is not pool
+                        _retire_pool(pool, grace)
+                        # 本次调用留在旧进程池中的后续任务也会被卡住或随子进程终止而失败，提前换到新进程池
+                        for later in range(index + 1, len(ranges)):
+                            if submitted[later][0] is pool and not submitted[later][1].done() and attempts[later] < 2:
+                                resubmit(later)
+                        # 自己卡死的区间不再重试，按超时处理；子进程崩溃或被终止时重新提交一次
+                        if attempts[index] >= 2 or (isinstance(e, FutureTimeoutError) and not retired):
+                            break
+                        resubmit(index)
+                if results is None:
+                    results = [('', True)] * (end - start)
+                for text, timed_out in results:
+                    stats['timed_out_pages'] += timed_out
+                    stats['extracted_pages'] += 1
+                    yield text
+        finally:
+            # 提前结束时只取消本次调用自己尚未开始的任务
+            for _, future in submitted:
+                future.cancel()
+    finally:
+        elapsed = time.perf_counter() - started
+        stats['seconds'] = round(elapsed, 3)
+        stats['pages_per_second'] = round(stats['extracted_pages'] / elapsed, 1) if elapsed > 0 else 0.0
+
+
+def extract_pdf_text(filepath, **options):
+    """提取整个 PDF 的文本，返回 (文本, 统计信息)"""
+    stats = {}
+    text = '\n'.join(iter_pdf_pages(filepath, stats=stats, **options))
+    return text, stats
@@ -0,0 +1,131 @@
+"""按 token 预算组装对话提示词
+
+按优先级依次填充预算：系统提示词和当前用户消息必定保留，
+然后从新到旧加入历史消息，最后用剩余预算放入知识库内容，并报告被丢弃的部分。
+"""
+import re
+
+# 中日韩文字及全角标点，每个字符大致对应一个 token
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# 每条消息的角色标记等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 知识库内容被截断时，剩余预算低于该值则直接丢弃而不截断
+MIN_TRUNCATED_TOKENS = 50
+
+
+def estimate_tokens(text):
+    """估算文本的 token 数：中文按每字 1 个，其他字符按每 4 个 1 个"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + (other_count + 3) // 4
+
+
+def truncate_to_tokens(text, max_tokens):
+    """截取文本开头不超过 max_tokens 的部分"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 二分查找满足预算的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def _split_turns(history):
+    """把历史消息按轮次分组：每轮以用户消息开头，包含其后的回复
+
+    开头没有对应用户消息的回复（历史窗口截断在一轮中间时）单独成一轮，不会被保留。
+    """
+    turns = []
+    for msg in history:
+        if msg['role'] == 'user' or not turns:
+            turns.append([msg])
+        else:
+            turns[-1].append(msg)
+    return turns
+
+
+def assemble_prompt(system_prompt, history, user_message, knowledge=None, budget=6000,
+                    knowledge_header='知识库内容：'):
+    """在 token 预算内组装消息列表
+
+    system_prompt 为系统提示词（可为 None），history 为按时间顺序排列的历史消息，
+    knowledge 为知识库文本列表（为 None 时不添加知识库段落）。
+    返回 (messages, report)，report 记录预算使用情况和被丢弃的内容。
+    """
+    report = {
+        'budget': budget,
+        'history_kept': 0,
+        'history_dropped': 0,
+        'history_turns_dropped': 0,
+        'knowledge_kept': 0,
+        'knowledge_dropped': 0,
+        'knowledge_truncated': False
+    }
+
+    # 1. 系统提示词和当前用户消息必定保留
+    used = estimate_tokens(user_message) + MESSAGE_OVERHEAD_TOKENS
+    if system_prompt is not None or knowledge is not None:
+        used += estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    if knowledge is not None:
+        used += estimate_tokens(f"\n\n{knowledge_header}\n")
+
+    # 2. 从最新的一轮对话开始整轮加入，遇到放不下的一轮即停止，保证历史连续且以用户消息开头
+    kept_turns = []
+    turns = _split_turns(history)
+    for turn in reversed(turns):
+        if turn[0]['role'] != 'user':
+            break
+        cost = sum(estimate_tokens(msg['content']) + MESSAGE_OVERHEAD_TOKENS for msg in turn)
+        if used + cost > budget:
+            break
+        kept_turns.append(turn)
+        used += cost
+    kept_history = [
+        {"role": msg['role'], "content": msg['content']} for turn in reversed(kept_turns) for msg in turn
+    ]
+    report['history_kept'] = len(kept_history)
+    report['history_dropped'] = len(history) - len(kept_history)
+    report['history_turns_dropped'] = len(turns) - len(kept_turns)
+
+    # 3. 用剩余预算按顺序放入知识库内容
+    kept_knowledge = []
+    if knowledge:
+        separator_cost = estimate_tokens("\n\n")
+        for item in knowledge:
+            separator = separator_cost if kept_knowledge else 0
+            cost = estimate_tokens(item) + separator
+            if used + cost > budget:
+                # 放不下时截断当前文档，剩余预算太少则直接停止
+                remaining = budget - used - separator
+                if remaining < MIN_TRUNCATED_TOKENS:
+                    break
+                item = truncate_to_tokens(item, remaining)
+                cost = estimate_tokens(item) + separator
+                report['knowledge_truncated'] = True
+            kept_knowledge.append(item)
+            used += cost
+            if report['knowledge_truncated']:
+                break
+        report['knowledge_dropped'] = len(knowledge) - len(kept_knowledge)
+    report['knowledge_kept'] = len(kept_knowledge)
+
+    messages = []
+    if system_prompt is not None or knowledge is not None:
+        content = system_prompt or ''
+        if knowledge is not None:
+            content += f"\n\n{knowledge_header}\n" + "\n\n".join(kept_knowledge)
+        messages.append({"role": "system", "content": content})
+    messages.extend(kept_history)
+    messages.append({"role": "user", "content": user_message})
+
+    report['estimated_tokens'] = used
+    return messages, report
@@ -0,0 +1,132 @@
+"""上游大模型接口的限流保护
+
+- AdaptiveLimiter：按 AIMD 方式根据延迟和 429/5xx 自适应调整并发上限
+- CircuitBreaker：连续失败达到阈值后熔断，在恢复期内直接快速失败
+- backoff_delay：带随机抖动的指数退避时间
+"""
+import random
+import threading
+import time
+
+
+class AdaptiveLimiter:
+    """AIMD 自适应并发限制：正常时缓慢加性增长，过载时乘性下降"""
+
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=32, latency_target=45.0,
+                 decrease_factor=0.5, decrease_cooldown=1.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self.stats_counter = {'increases': 0, 'decreases': 0, 'rejected': 0}
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self, timeout=None):
+        """获取一个并发配额，超时返回 False"""
+        with self._condition:
+            acquired = self._condition.wait_for(lambda: self._in_flight < int(self._limit), timeout=timeout)
+            if not acquired:
+                self.stats_counter['rejected'] += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, latency, overloaded=False):
+        """归还配额并根据本次调用的延迟和是否过载调整并发上限"""
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded or latency > self.latency_target:
+                # 同一波过载只下降一次，避免并发上限瞬间跌到底
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self.stats_counter['decreases'] += 1
+            elif self._limit < self.max_limit:
+                # 每完成约 limit 个成功调用，上限加 1
+                self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+                self.stats_counter['increases'] += 1
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self.stats_counter)
+            stats['limit'] = int(self._limit)
+            stats['in_flight'] = self._in_flight
+        return stats
+
+
+class CircuitBreaker:
+    """熔断器：closed -> open（快速失败）-> half_open（放行一个试探请求）"""
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.stats_counter = {'opened': 0, 'short_circuited': 0}
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """是否允许发起调用"""
+        with self._lock:
+            if self._state == 'open':
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    self.stats_counter['short_circuited'] += 1
+                    return False
+                self._state = 'half_open'
+                self._probe_in_flight = False
+            if self._state == 'half_open':
+                if self._probe_in_flight:
+                    self.stats_counter['short_circuited'] += 1
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def cancel(self):
+        """已放行的调用未真正发出（如等待并发配额超时），不计入成功或失败"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._state = 'closed'
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == 'half_open' or self._failures >= self.failure_threshold:
+                if self._state != 'open':
+                    self.stats_counter['opened'] += 1
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counter)
+            stats['open'] = 1 if self._state == 'open' else 0
+            stats['consecutive_failures'] = self._failures
+        return stats
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=8.0):
+    """第 attempt 次重试前的等待时间（full jitter 指数退避）"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
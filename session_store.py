@@ -0,0 +1,815 @@
+"""会话存储
+
+会话、消息、初始 prompt 和知识库文档引用的存储，提供两种实现：
+
+- MemorySessionStore：进程内字典，按会话 ID 分片加锁，重启后丢失，适合测试和单进程调试
+- SQLiteSessionStore：SQLite（WAL 模式）持久化，多个 worker 进程可共享同一个数据库；
+  写操作进入队列，由后台线程攒批后在一个事务中提交，读操作前会先等待本进程未提交的写入完成；
+  追加对话消息时等待写入提交，写入失败、后台线程异常退出或等待超时时抛出 SessionStoreError
+
+会话以字典表示：id、mode、title、messages、message_count、created_at、updated_at。
+被会话引用的知识库文档随引用保存一份提取的文本和摘要，文档文本缓存淘汰或服务重启后仍能重新加载；
+没有会话再引用的文档随之删除。
+会话列表只返回摘要（不含消息），按 (updated_at, id) 倒序分页，游标为上一页最后一条的位置。
+"""
+import base64
+import bisect
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from bounded_state import BoundedState
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS sessions ('
+    'id TEXT PRIMARY KEY, mode TEXT NOT NULL, title TEXT NOT NULL, '
+    'message_count INTEGER NOT NULL DEFAULT 0, '
+    'created_at TEXT NOT NULL, updated_at TEXT NOT NULL)',
+    # 会话列表按 (updated_at, id) 倒序分页，只包含有消息的会话
+    'DROP INDEX IF EXISTS idx_sessions_updated_at',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_listing ON sessions (updated_at, id) WHERE message_count > 0',
+    'CREATE TABLE IF NOT EXISTS messages ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, '
+    'role TEXT NOT NULL, content TEXT NOT NULL, timestamp TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id)',
+    'CREATE TABLE IF NOT EXISTS prompts (session_id TEXT PRIMARY KEY, prompt TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS knowledge_refs ('
+    'session_id TEXT NOT NULL, document_key TEXT NOT NULL, filename TEXT NOT NULL, '
+    'added_at REAL NOT NULL, PRIMARY KEY (session_id, document_key))',
+    'CREATE INDEX IF NOT EXISTS idx_knowledge_refs_document ON knowledge_refs (document_key)',
+    'CREATE TABLE IF NOT EXISTS documents (document_key TEXT PRIMARY KEY, content TEXT NOT NULL, digest TEXT)'
+]
+# 删除知识库引用后清理没有会话再引用的文档
+PRUNE_DOCUMENTS = (
+    'DELETE FROM documents WHERE NOT EXISTS '
+    '(SELECT 1 FROM knowledge_refs WHERE knowledge_refs.document_key = documents.document_key)',
+    ()
+)
+
+SESSION_FIELDS = ('mode', 'title', 'updated_at')
+# 估算内存会话占用时每个会话和每条消息的固定开销 (字节)
+SESSION_OVERHEAD = 512
+MESSAGE_OVERHEAD = 256
+SUMMARY_FIELDS = ('id', 'title', 'mode', 'updated_at', 'message_count')
+
+
+class SessionStoreError(Exception):
+    """会话写入失败或未能在限定时间内提交"""
+
+
+def encode_cursor(updated_at, session_id):
+    """把分页位置编码为不透明的游标字符串"""
+    return base64.urlsafe_b64encode(json.dumps([updated_at, session_id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """解析游标，返回 (updated_at, id)；游标无效时抛出 ValueError"""
+    try:
+        updated_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('无效的分页游标')
+    if not isinstance(updated_at, str) or not isinstance(session_id, str):
+        raise ValueError('无效的分页游标')
+    return updated_at, session_id
+
+
+def _page(summaries, limit):
+    """截取一页摘要，返回 (摘要列表, 下一页游标)；summaries 需多取一条用于判断是否还有下一页"""
+    if len(summaries) <= limit:
+        return summaries, None
+    summaries = summaries[:limit]
+    last = summaries[-1]
+    return summaries, encode_cursor(last['updated_at'], last['id'])
+
+
+class _DocumentTexts:
+    """内存会话存储中被引用文档的文本和摘要，按引用它的会话数计数，归零时删除"""
+
+    def __init__(self):
+        self._documents = {}   # 文档键 -> {'content', 'digest', 'refs'}
+        self._lock = threading.Lock()
+
+    def retain(self, key, content):
+        with self._lock:
+            document = self._documents.setdefault(key, {'content': None, 'digest': None, 'refs': 0})
+            if document['content'] is None:
+                document['content'] = content
+            document['refs'] += 1
+
+    def release(self, refs):
+        """释放一组引用 [(文档键, 文件名)]"""
+        with self._lock:
+            for key, _ in refs or []:
+                document = self._documents.get(key)
+                if document is None:
+                    continue
+                document['refs'] -= 1
+                if document['refs'] <= 0:
+                    del self._documents[key]
+
+    def set_digest(self, key, digest):
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                document['digest'] = digest
+
+    def get(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            if document is None or document['content'] is None:
+                return None
+            return {'content': document['content'], 'digest': document['digest']}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._documents)
+
+
+class _MemoryShard:
+    """内存会话存储的一个分片，由分片锁保护
+
+    会话的容量和淘汰由 MemorySessionStore 全局统计，淘汰时调用 evict，会话的 prompt 和知识库引用随之删除；
+    临时会话的 prompt 和引用按空闲时间过期，条目数上限只作为兜底。
+    """
+
+    def __init__(self, max_sessions=None, idle_ttl=None, documents=None):
+        self._documents = documents if documents is not None else _DocumentTexts()
+        self._sessions = {}
+        self._prompts = BoundedState(max_entries=max_sessions, idle_ttl=idle_ttl)
+        self._knowledge_refs = BoundedState(
+            max_entries=max_sessions,
+            idle_ttl=idle_ttl,
+            on_evict=lambda session_id, refs: self._documents.release(refs)
+        )
+        # 有消息的会话按 (updated_at, id) 升序排列，分页时从尾部倒序读取
+        self._recent = []
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _message_size(message):
+        return MESSAGE_OVERHEAD + len(message['content'].encode('utf-8'))
+
+    def evict(self, session_id, session):
+        """删除被淘汰的会话；同 ID 的会话已被删除后重新创建时保留新会话"""
+        with self._lock:
+            if self._sessions.get(session_id) is not session:
+                return
+            del self._sessions[session_id]
+            self._unindex(session)
+            self._prompts.pop(session_id)
+            self._documents.release(self._knowledge_refs.pop(session_id))
+
+    def _index(self, session):
+        if session['messages']:
+            bisect.insort(self._recent, (session['updated_at'], session['id']))
+
+    def _unindex(self, session):
+        key = (session['updated_at'], session['id'])
+        position = bisect.bisect_left(self._recent, key)
+        if position < len(self._recent) and self._recent[position] == key:
+            del self._recent[position]
+
+    def _snapshot(self, session, message_limit=None):
+        messages = session['messages']
+        if message_limit is not None:
+            messages = messages[-message_limit:] if message_limit > 0 else []
+        snapshot = dict(session, messages=[dict(message) for message in messages])
+        snapshot['message_count'] = len(session['messages'])
+        del snapshot['_size']
+        return snapshot
+
+    def create_session(self, session):
+        """保存会话，返回保存的会话对象，由调用方计入全局容量"""
+        with self._lock:
+            session = dict(session, messages=list(session.get('messages', [])))
+            session.pop('message_count', None)
+            session['_size'] = SESSION_OVERHEAD + sum(self._message_size(m) for m in session['messages'])
+            previous = self._sessions.get(session['id'])
+            if previous is not None:
+                self._unindex(previous)
+            self._index(session)
+            self._sessions[session['id']] = session
+            return session
+
+    def get_session(self, session_id, message_limit=None):
+        """获取会话，message_limit 限制只返回最近的若干条消息"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return self._snapshot(session, message_limit) if session else None
+
+    def session_exists(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def get_messages(self, session_id, start=0, after=None):
+        """增量获取消息：after 为时间戳时返回其后的消息，否则返回从第 start 条开始的消息"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return []
+            if after:
+                messages = [message for message in session['messages'] if message['timestamp'] > after]
+            else:
+                messages = session['messages'][start:]
+            return [dict(message) for message in messages]
+
+    def update_session(self, session_id, **fields):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._unindex(session)
+                session.update({key: value for key, value in fields.items() if key in SESSION_FIELDS})
+                self._index(session)
+
+    def append_messages(self, session_id, messages, updated_at):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._unindex(session)
+                messages = [dict(message) for message in messages]
+                session['messages'].extend(messages)
+                session['_size'] += sum(self._message_size(m) for m in messages)
+                session['updated_at'] = updated_at
+                self._index(session)
+
+    def delete_session(self, session_id):
+        """删除会话及其消息、prompt 和知识库引用，会话不存在时返回 False"""
+        with self._lock:
+            self._prompts.pop(session_id)
+            self._documents.release(self._knowledge_refs.pop(session_id))
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                return False
+            self._unindex(session)
+            return True
+
+    def summaries_before(self, limit, position=None):
+        """(updated_at, id) 小于 position 的最多 limit 个会话摘要，按更新时间倒序"""
+        with self._lock:
+            end = bisect.bisect_left(self._recent, position) if position else len(self._recent)
+            keys = self._recent[max(0, end - limit):end][::-1]
+            summaries = []
+            for _, session_id in keys:
+                # 列出会话不算访问，不影响淘汰顺序
+                session = self._sessions[session_id]
+                summaries.append({
+                    'id': session_id,
+                    'title': session['title'],
+                    'mode': session['mode'],
+                    'updated_at': session['updated_at'],
+                    'message_count': len(session['messages'])
+                })
+        return summaries
+
+    def set_prompt(self, session_id, prompt):
+        self._prompts.set(session_id, prompt)
+
+    def get_prompt(self, session_id):
+        return self._prompts.get(session_id)
+
+    def add_knowledge_ref(self, session_id, document_key, filename, content=None):
+        with self._lock:
+            refs = self._knowledge_refs.setdefault(session_id, list)
+            if all(key != document_key for key, _ in refs):
+                refs.append((document_key, filename))
+                self._documents.retain(document_key, content)
+
+    def get_knowledge_refs(self, session_id):
+        """会话引用的文档 [(文档键, 文件名)]，按加入顺序"""
+        return list(self._knowledge_refs.get(session_id, []))
+
+    def clear_knowledge_refs(self, session_id):
+        self._documents.release(self._knowledge_refs.pop(session_id))
+
+    def take_temp(self, temp_id):
+        """取出临时会话的 (prompt, 知识库引用)"""
+        with self._lock:
+            return self._prompts.pop(temp_id), self._knowledge_refs.pop(temp_id)
+
+    def put_temp(self, session_id, prompt, refs):
+        with self._lock:
+            if prompt is not None:
+                self._prompts.set(session_id, prompt)
+            if refs is not None:
+                self._documents.release(self._knowledge_refs.pop(session_id))
+                self._knowledge_refs.set(session_id, refs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'messages': sum(len(s['messages']) for s in self._sessions.values()),
+                'prompts': len(self._prompts),
+                'knowledge_refs': len(self._knowledge_refs)
+            }
+
+
+class MemorySessionStore:
+    """进程内会话存储：按会话 ID 分片，每个分片一把锁，不同会话的读写互不阻塞
+
+    会话数和估算字节数的上限、空闲过期对整个存储生效：所有会话在一个全局的 LRU 中统计，
+    它只在分片锁之外更新，临界区只有链表操作。被淘汰的会话直接丢弃，需要持久化时使用 SQLiteSessionStore。
+    """
+
+    def __init__(self, max_sessions=None, max_bytes=None, idle_ttl=None, shards=16):
+        # 被引用文档的文本由所有分片共享
+        self._documents = _DocumentTexts()
+        self._shards = [_MemoryShard(max_sessions, idle_ttl, self._documents) for _ in range(shards)]
+        self._usage = BoundedState(
+            max_entries=max_sessions,
+            max_bytes=max_bytes,
+            idle_ttl=idle_ttl,
+            sizeof=lambda session: session['_size'],
+            on_evict=lambda session_id, session: self._shard(session_id).evict(session_id, session)
+        )
+
+    def _shard(self, session_id):
+        return self._shards[zlib.crc32(session_id.encode('utf-8')) % len(self._shards)]
+
+    def create_session(self, session):
+        stored = self._shard(session['id']).create_session(session)
+        self._usage.set(session['id'], stored)
+
+    def get_session(self, session_id, message_limit=None):
+        """获取会话，message_limit 限制只返回最近的若干条消息"""
+        self._usage.get(session_id)
+        return self._shard(session_id).get_session(session_id, message_limit)
+
+    def session_exists(self, session_id):
+        self._usage.expire()
+        return self._shard(session_id).session_exists(session_id)
+
+    def get_messages(self, session_id, start=0, after=None):
+        """增量获取消息：after 为时间戳时返回其后的消息，否则返回从第 start 条开始的消息"""
+        self._usage.get(session_id)
+        return self._shard(session_id).get_messages(session_id, start, after)
+
+    def update_session(self, session_id, **fields):
+        self._usage.get(session_id)
+        self._shard(session_id).update_session(session_id, **fields)
+
+    def append_messages(self, session_id, messages, updated_at):
+        self._usage.get(session_id)
+        self._shard(session_id).append_messages(session_id, messages, updated_at)
+        # 会话变大后重新计算全局占用，可能淘汰其他分片中最久未访问的会话
+        self._usage.resize(session_id)
+
+    def delete_session(self, session_id):
+        """删除会话及其消息、prompt 和知识库引用，会话不存在时返回 False"""
+        deleted = self._shard(session_id).delete_session(session_id)
+        self._usage.pop(session_id)
+        return deleted
+
+    def list_sessions(self, limit=50, cursor=None):
+        """有消息的会话摘要，按更新时间倒序分页，返回 (摘要列表, 下一页游标)
+
+        各分片分别取出游标之前的 limit + 1 条，再归并排序。
+        """
+        position = decode_cursor(cursor) if cursor else None
+        self._usage.expire()
+        pages = [shard.summaries_before(limit + 1, position) for shard in self._shards]
+        merged = heapq.merge(*pages, key=lambda summary: (summary['updated_at'], summary['id']), reverse=True)
+        return _page(list(itertools.islice(merged, limit + 1)), limit)
+
+    def set_prompt(self, session_id, prompt):
+        self._shard(session_id).set_prompt(session_id, prompt)
+
+    def get_prompt(self, session_id):
+        return self._shard(session_id).get_prompt(session_id)
+
+    def add_knowledge_ref(self, session_id, document_key, filename, content=None):
+        """记录会话引用的文档，content 为提取的文本，文档尚未保存时一并保存"""
+        self._shard(session_id).add_knowledge_ref(session_id, document_key, filename, content)
+
+    def get_knowledge_refs(self, session_id):
+        """会话引用的文档 [(文档键, 文件名)]，按加入顺序"""
+        return self._shard(session_id).get_knowledge_refs(session_id)
+
+    def clear_knowledge_refs(self, session_id):
+        self._shard(session_id).clear_knowledge_refs(session_id)
+
+    def set_document_digest(self, document_key, digest):
+        self._documents.set_digest(document_key, digest)
+
+    def get_document(self, document_key):
+        """被会话引用的文档 {'content', 'digest'}，没有保存时返回 None"""
+        return self._documents.get(document_key)
+
+    def move_temp(self, session_id, temp_id='temp'):
+        """把临时会话的 prompt 和知识库引用原子地迁移到正式会话
+
+        同时持有两个分片的锁（按分片顺序加锁，避免死锁），迁移过程中其他线程看不到中间状态。
+        """
+        source, target = self._shard(temp_id), self._shard(session_id)
+        shards = sorted({id(source): source, id(target): target}.values(), key=self._shards.index)
+        with contextlib.ExitStack() as stack:
+            for shard in shards:
+                stack.enter_context(shard._lock)
+            prompt, refs = source.take_temp(temp_id)
+            target.put_temp(session_id, prompt, refs)
+
+    def flush(self, timeout=None):
+        return True
+
+    def stats(self):
+        stats = {}
+        for shard in self._shards:
+            for key, value in shard.stats().items():
+                stats[key] = stats.get(key, 0) + value
+        usage = self._usage.stats()
+        stats['bytes'] = usage['bytes']
+        stats['evictions'] = usage['evictions']
+        stats['expirations'] = usage['expirations']
+        stats['shards'] = len(self._shards)
+        stats['documents'] = len(self._documents)
+        return stats
+
+
+class SessionLocks:
+    """按会话的写锁：同一会话的对话轮次依次执行，不同会话互不阻塞
+
+    每个会话的锁只在有线程持有或等待时存在，锁表按会话 ID 分片，各分片有自己的互斥锁。
+    只在本进程内生效，多个 worker 进程之间不互斥。
+    """
+
+    def __init__(self, shards=16):
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+
+    def acquire(self, session_id, timeout=None):
+        """获取会话的写锁，返回 SessionLock；超时返回 None"""
+        mutex, locks = self._shards[zlib.crc32(session_id.encode('utf-8')) % len(self._shards)]
+        with mutex:
+            entry = locks.get(session_id)
+            if entry is None:
+                entry = locks[session_id] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        if entry[0].acquire(timeout=-1 if timeout is None else timeout):
+            return SessionLock(self, session_id, entry)
+        self._unref(session_id, entry)
+        return None
+
+    def _unref(self, session_id, entry):
+        mutex, locks = self._shards[zlib.crc32(session_id.encode('utf-8')) % len(self._shards)]
+        with mutex:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del locks[session_id]
+
+    @contextlib.contextmanager
+    def hold(self, session_id):
+        lock = self.acquire(session_id)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self):
+        held = 0
+        waiting = 0
+        for mutex, locks in self._shards:
+            with mutex:
+                for lock, refs in locks.values():
+                    locked = lock.locked()
+                    held += locked
+                    waiting += refs - locked
+        return {'held': held, 'waiting': waiting}
+
+
+class SessionLock:
+    """已持有的会话写锁，release() 可重复调用"""
+
+    def __init__(self, locks, session_id, entry):
+        self._locks = locks
+        self._session_id = session_id
+        self._entry = entry
+        self._released = False
+        self._guard = threading.Lock()
+
+    def release(self):
+        with self._guard:
+            if self._released:
+                return
+            self._released = True
+        self._entry[0].release()
+        self._locks._unref(self._session_id, self._entry)
+
+
+class SQLiteSessionStore:
+    """SQLite（WAL）会话存储，写操作由后台线程批量提交"""
+
+    def __init__(self, db_path, flush_interval=0.02, max_batch=500, write_timeout=30):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.write_timeout = write_timeout
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+
+        # 写队列：每项为需要在同一事务中执行的一组 (sql, params)
+        self._queue = []
+        self._enqueued = 0
+        self._committed = 0
+        # 等待结果的写入序号，以及其中失败的写入：序号 -> 错误
+        self._waiting = set()
+        self._failures = {}
+        self._writer_error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self.stats_counter = {'batches': 0, 'writes': 0, 'write_errors': 0}
+        self._writer = threading.Thread(target=self._write_loop, name='session-store-writer', daemon=True)
+        self._writer.start()
+
+    def _connection(self):
+        """每个线程使用自己的连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _write(self, *statements, wait=False):
+        """把一组语句加入写队列，同一组语句在同一事务中执行
+
+        wait 为 True 时等待这组语句提交，失败或超时抛出 SessionStoreError。
+        """
+        with self._condition:
+            self._check_writer()
+            self._queue.append(statements)
+            self._enqueued += 1
+            seq = self._enqueued
+            if wait:
+                self._waiting.add(seq)
+            self._condition.notify_all()
+        if wait:
+            self._wait_for(seq)
+
+    def _check_writer(self):
+        """后台写线程已异常退出时抛出 SessionStoreError（需持有 _condition）"""
+        if self._writer_error is not None:
+            raise SessionStoreError(f'会话存储写线程已停止: {self._writer_error}')
+
+    def _wait_for(self, seq, timeout=None):
+        """等待序号不超过 seq 的写入提交，返回前取出 seq 本身的写入错误并抛出"""
+        timeout = self.write_timeout if timeout is None else timeout
+        with self._condition:
+            try:
+                done = self._condition.wait_for(
+                    lambda: self._committed >= seq or self._writer_error is not None, timeout=timeout
+                )
+                if self._committed < seq:
+                    self._check_writer()
+                if not done:
+                    raise SessionStoreError(f'会话写入超过 {timeout} 秒仍未提交')
+                error = self._failures.pop(seq, None)
+            finally:
+                self._waiting.discard(seq)
+                self._failures.pop(seq, None)
+        if error is not None:
+            raise SessionStoreError(f'会话写入失败: {error}')
+
+    def _execute_batch(self, conn, batch):
+        with conn:
+            for statements in batch:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+
+    def _write_loop(self):
+        try:
+            self._write_batches()
+        except Exception as e:
+            # 写线程异常退出后不再有写入提交，让等待中和之后的读写立即报错，而不是一直等待
+            print(f"会话存储写线程异常退出: {str(e)}")
+            with self._condition:
+                self._writer_error = e
+                self._condition.notify_all()
+
+    def _write_batches(self):
+        conn = self._connection()
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closed)
+                if self._closed and not self._queue:
+                    return
+            # 稍等片刻，让同一时间段的写入合并到一个事务
+            time.sleep(self.flush_interval)
+            with self._condition:
+                batch = self._queue[:self.max_batch]
+                del self._queue[:len(batch)]
+                first_seq = self._committed + 1
+            try:
+                self._execute_batch(conn, batch)
+            except sqlite3.Error as e:
+                # 整批失败时逐组重试，避免一条错误的写入拖累同批的其他写入
+                print(f"会话存储批量写入失败，逐条重试: {str(e)}")
+                for seq, statements in enumerate(batch, first_seq):
+                    try:
+                        self._execute_batch(conn, [statements])
+                    except sqlite3.Error as item_error:
+                        print(f"会话存储写入失败: {str(item_error)}")
+                        with self._condition:
+                            self.stats_counter['write_errors'] += 1
+                            # 只为有调用方等待的写入保留错误，由调用方取走
+                            if seq in self._waiting:
+                                self._failures[seq] = item_error
+            with self._condition:
+                self._committed += len(batch)
+                self.stats_counter['batches'] += 1
+                self.stats_counter['writes'] += len(batch)
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """等待本进程已提交到队列的写入全部写入数据库，最多等待 timeout（默认 write_timeout）秒
+
+        写线程已停止或等待超时时抛出 SessionStoreError。
+        """
+        with self._condition:
+            target = self._enqueued
+        self._wait_for(target, timeout)
+        return True
+
+    def _read(self, sql, params=()):
+        # 保证读到本进程之前的写入
+        if self._committed < self._enqueued:
+            self.flush()
+        return self._connection().execute(sql, params).fetchall()
+
+    def _messages(self, session_id, message_limit=None):
+        if message_limit is None:
+            rows = self._read(
+                'SELECT role, content, timestamp FROM messages WHERE session_id = ? ORDER BY id', (session_id,)
+            )
+        elif message_limit <= 0:
+            rows = []
+        else:
+            rows = self._read(
+                'SELECT role, content, timestamp FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?',
+                (session_id, message_limit)
+            )[::-1]
+        return [dict(row) for row in rows]
+
+    def create_session(self, session):
+        self._write((
+            'INSERT INTO sessions (id, mode, title, message_count, created_at, updated_at) VALUES (?, ?, ?, 0, ?, ?)',
+            (session['id'], session['mode'], session['title'], session['created_at'], session['updated_at'])
+        ))
+
+    def get_session(self, session_id, message_limit=None):
+        """获取会话，message_limit 限制只返回最近的若干条消息"""
+        rows = self._read('SELECT * FROM sessions WHERE id = ?', (session_id,))
+        if not rows:
+            return None
+        session = dict(rows[0])
+        session['messages'] = self._messages(session_id, message_limit)
+        return session
+
+    def session_exists(self, session_id):
+        return bool(self._read('SELECT 1 FROM sessions WHERE id = ?', (session_id,)))
+
+    def get_messages(self, session_id, start=0, after=None):
+        """增量获取消息：after 为时间戳时返回其后的消息，否则返回从第 start 条开始的消息"""
+        if after:
+            rows = self._read(
+                'SELECT role, content, timestamp FROM messages WHERE session_id = ? AND timestamp > ? ORDER BY id',
+                (session_id, after)
+            )
+        else:
+            rows = self._read(
+                'SELECT role, content, timestamp FROM messages WHERE session_id = ? ORDER BY id LIMIT -1 OFFSET ?',
+                (session_id, start)
+            )
+        return [dict(row) for row in rows]
+
+    def update_session(self, session_id, **fields):
+        fields = {key: value for key, value in fields.items() if key in SESSION_FIELDS}
+        if not fields:
+            return
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        self._write((f'UPDATE sessions SET {assignments} WHERE id = ?', tuple(fields.values()) + (session_id,)))
+
+    def append_messages(self, session_id, messages, updated_at):
+        statements = [
+            ('INSERT INTO messages (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+             (session_id, message['role'], message['content'], message['timestamp']))
+            for message in messages
+        ]
+        statements.append((
+            'UPDATE sessions SET message_count = message_count + ?, updated_at = ? WHERE id = ?',
+            (len(messages), updated_at, session_id)
+        ))
+        # 对话消息写入失败时调用方需要知道，等待提交结果
+        self._write(*statements, wait=True)
+
+    def delete_session(self, session_id):
+        """删除会话及其消息、prompt 和知识库引用，会话不存在时返回 False"""
+        if not self.session_exists(session_id):
+            return False
+        self._write(
+            ('DELETE FROM messages WHERE session_id = ?', (session_id,)),
+            ('DELETE FROM prompts WHERE session_id = ?', (session_id,)),
+            ('DELETE FROM knowledge_refs WHERE session_id = ?', (session_id,)),
+            PRUNE_DOCUMENTS,
+            ('DELETE FROM sessions WHERE id = ?', (session_id,))
+        )
+        return True
+
+    def list_sessions(self, limit=50, cursor=None):
+        """有消息的会话摘要，按更新时间倒序分页，返回 (摘要列表, 下一页游标)"""
+        columns = ', '.join(SUMMARY_FIELDS)
+        if cursor:
+            rows = self._read(
+                f'SELECT {columns} FROM sessions WHERE message_count > 0 AND (updated_at, id) < (?, ?) '
+                'ORDER BY updated_at DESC, id DESC LIMIT ?',
+                decode_cursor(cursor) + (limit + 1,)
+            )
+        else:
+            rows = self._read(
+                f'SELECT {columns} FROM sessions WHERE message_count > 0 ORDER BY updated_at DESC, id DESC LIMIT ?',
+                (limit + 1,)
+            )
+        return _page([dict(row) for row in rows], limit)
+
+    def set_prompt(self, session_id, prompt):
+        self._write(('INSERT OR REPLACE INTO prompts (session_id, prompt) VALUES (?, ?)', (session_id, prompt)))
+
+    def get_prompt(self, session_id):
+        rows = self._read('SELECT prompt FROM prompts WHERE session_id = ?', (session_id,))
+        return rows[0]['prompt'] if rows else None
+
+    def add_knowledge_ref(self, session_id, document_key, filename, content=None):
+        """记录会话引用的文档，content 为提取的文本，文档尚未保存时一并保存"""
+        statements = [(
+            'INSERT OR IGNORE INTO knowledge_refs (session_id, document_key, filename, added_at) VALUES (?, ?, ?, ?)',
+            (session_id, document_key, filename, time.time())
+        )]
+        if content is not None:
+            statements.append((
+                'INSERT OR IGNORE INTO documents (document_key, content) VALUES (?, ?)', (document_key, content)
+            ))
+        self._write(*statements)
+
+    def get_knowledge_refs(self, session_id):
+        """会话引用的文档 [(文档键, 文件名)]，按加入顺序"""
+        rows = self._read(
+            'SELECT document_key, filename FROM knowledge_refs WHERE session_id = ? ORDER BY added_at', (session_id,)
+        )
+        return [(row['document_key'], row['filename']) for row in rows]
+
+    def clear_knowledge_refs(self, session_id):
+        self._write(('DELETE FROM knowledge_refs WHERE session_id = ?', (session_id,)), PRUNE_DOCUMENTS)
+
+    def set_document_digest(self, document_key, digest):
+        self._write(('UPDATE documents SET digest = ? WHERE document_key = ?', (digest, document_key)))
+
+    def get_document(self, document_key):
+        """被会话引用的文档 {'content', 'digest'}，没有保存时返回 None"""
+        rows = self._read('SELECT content, digest FROM documents WHERE document_key = ?', (document_key,))
+        return dict(rows[0]) if rows else None
+
+    def move_temp(self, session_id, temp_id='temp'):
+        """把临时会话的 prompt 和知识库引用迁移到正式会话"""
+        self._write(
+            ('UPDATE prompts SET session_id = ? WHERE session_id = ?', (session_id, temp_id)),
+            ('UPDATE knowledge_refs SET session_id = ? WHERE session_id = ?', (session_id, temp_id))
+        )
+
+    def stats(self):
+        counts = self._read('SELECT COUNT(*) AS sessions, COALESCE(SUM(message_count), 0) AS messages FROM sessions')[0]
+        with self._condition:
+            stats = dict(self.stats_counter)
+            stats['pending_writes'] = self._enqueued - self._committed
+        stats['sessions'] = counts['sessions']
+        stats['messages'] = counts['messages']
+        stats['documents'] = self._read('SELECT COUNT(*) AS documents FROM documents')[0]['documents']
+        return stats
+
+    def close(self):
+        """提交剩余写入并停止后台线程"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+
+
+def create_session_store(kind='sqlite', db_path=None, flush_interval=0.02, max_sessions=None, max_bytes=None,
+                         idle_ttl=None, write_timeout=30):
+    """按配置创建会话存储：sqlite 或 memory（容量上限只对 memory 生效）"""
+    if kind == 'memory':
+        return MemorySessionStore(max_sessions, max_bytes, idle_ttl)
+    return SQLiteSessionStore(db_path, flush_interval=flush_interval, write_timeout=write_timeout)
@@ -0,0 +1,64 @@
+"""相同请求合并（single-flight）
+
+并发到达的相同请求只向上游发起一次调用，其余调用方等待并共享同一结果。
+"""
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """按键合并进行中的调用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats_counter = {
+            'calls': 0,
+            'executed': 0,
+            'folded': 0
+        }
+
+    def do(self, key, func):
+        """执行 func()；若相同 key 的调用正在进行，则等待并返回其结果（或抛出其异常）"""
+        with self._lock:
+            self.stats_counter['calls'] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.stats_counter['folded'] += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.stats_counter['executed'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """返回合并统计"""
+        with self._lock:
+            stats = dict(self.stats_counter)
+            stats['in_flight'] = len(self._calls)
+        stats['fold_rate'] = stats['folded'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
@@ -2,6 +2,10 @@
 let currentSessionId = null;
 let currentMode = 'normal';
 let uploadedFiles = [];
+let loadedSessions = [];
+// 已加载的会话详情及其 ETag，再次打开时只获取新消息
+const sessionDetailCache = {};
+let sessionsNextCursor = null;
 
 // 初始化应用
 async function init() {
@@ -88,20 +92,39 @@ function setupEventListeners() {
         uploadStatus.style.color = '#3b82f6';
 
         const formData = new FormData();
-        formData.append('file', file);
         formData.append('session_id', currentSessionId || 'temp');
 
         try {
+            await appendUploadFile(formData, file, ratio => {
+                uploadStatus.textContent = `正在上传文件... ${Math.round(ratio * 100)}%`;
+            });
             const response = await fetch('/api/upload', { method: 'POST', body: formData });
             const data = await response.json();
+            if (!response.ok) {
+                uploadStatus.textContent = '上传失败: ' + data.error;
+                uploadStatus.style.color = '#ef4444';
+                this.value = '';
+                return;
+            }
             
-            if (response.ok) {
-                uploadedFiles.push({ name: data.filename, size: data.content_length || 0 });
+            // 文件已上传，解析和索引在后台进行，轮询入库进度
+            let job = { status: data.status };
+            while (job.status === 'queued' || job.status === 'running') {
+                uploadStatus.textContent = job.status === 'queued' ? '文件已上传，等待解析...' : `正在${job.stage || '处理文件'}...`;
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                const statusResponse = await fetch(`/api/upload/${data.ingestion_id}`);
+                job = await statusResponse.json();
+                if (!statusResponse.ok) break;
+            }
+            
+            if (job.status === 'succeeded') {
+                const result = job.result;
+                uploadedFiles.push({ name: result.filename, size: result.content_length || 0 });
                 updateFileList();
-                uploadStatus.textContent = `文件上传成功！已读取 ${data.content_length || 0} 个字符`;
+                uploadStatus.textContent = `文件上传成功！已读取 ${result.content_length || 0} 个字符`;
                 uploadStatus.style.color = '#10b981';
             } else {
-                uploadStatus.textContent = '上传失败: ' + data.error;
+                uploadStatus.textContent = '上传失败: ' + (job.error || '文件处理失败');
                 uploadStatus.style.color = '#ef4444';
             }
         } catch (error) {
@@ -212,7 +235,7 @@ async function sendMessage() {
     chatMessages.scrollTop = chatMessages.scrollHeight;
 
     try {
-        const response = await fetch('/api/chat', {
+        const response = await fetch('/api/chat/stream', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ 
@@ -222,22 +245,72 @@ async function sendMessage() {
             })
         });
 
-        const data = await response.json();
-        
-        chatMessages.removeChild(placeholderDiv);
-        
-        if (response.ok) {
-            addMessageWithTypingEffect(data.reply, false);
-            if (data.session_id && data.session_id !== currentSessionId) {
-                currentSessionId = data.session_id;
+        if (!response.ok) {
+            const data = await response.json();
+            chatMessages.removeChild(placeholderDiv);
+            addMessage(`错误: ${data.error}`, false);
+        } else {
+            // 逐段读取SSE事件，收到第一个片段即开始显示
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder('utf-8');
+            let buffer = '';
+            let started = false;
+            let sessionId = null;
+            let streamError = null;
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let eventName = 'message';
+                    let dataText = '';
+                    rawEvent.split('\n').forEach(line => {
+                        if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                        else if (line.startsWith('data:')) dataText += line.slice(5).trim();
+                    });
+                    if (!dataText) continue;
+                    const data = JSON.parse(dataText);
+
+                    if (eventName === 'session') {
+                        sessionId = data.session_id;
+                    } else if (eventName === 'error') {
+                        streamError = data.error;
+                    } else if (eventName === 'done') {
+                        if (!started) {
+                            contentDiv.classList.remove('typing');
+                            contentDiv.textContent = data.reply;
+                            started = true;
+                        }
+                    } else if (data.delta) {
+                        if (!started) {
+                            contentDiv.classList.remove('typing');
+                            contentDiv.textContent = '';
+                            started = true;
+                        }
+                        contentDiv.textContent += data.delta;
+                        chatMessages.scrollTop = chatMessages.scrollHeight;
+                    }
+                }
+            }
+
+            if (streamError) {
+                chatMessages.removeChild(placeholderDiv);
+                addMessage(`错误: ${streamError}`, false);
+            }
+            if (sessionId && sessionId !== currentSessionId) {
+                currentSessionId = sessionId;
                 await loadSessions();
                 updateModeDisplay();
             }
-        } else {
-            addMessage(`错误: ${data.error}`, false);
         }
     } catch (error) {
-        chatMessages.removeChild(placeholderDiv);
+        if (placeholderDiv.parentNode) chatMessages.removeChild(placeholderDiv);
         addMessage(`网络错误: ${error.message}`, false);
     }
 
@@ -246,11 +319,16 @@ async function sendMessage() {
 }
 
 // 会话管理函数
-async function loadSessions() {
+async function loadSessions(more = false) {
     try {
-        const response = await fetch('/api/sessions');
-        const sessions = await response.json();
-        renderSessionList(sessions);
+        // 列表只含会话摘要，分页加载；刷新时只重新获取第一页
+        let url = '/api/sessions';
+        if (more && sessionsNextCursor) url += `?cursor=${encodeURIComponent(sessionsNextCursor)}`;
+        const response = await fetch(url);
+        const page = await response.json();
+        loadedSessions = more ? loadedSessions.concat(page.sessions) : page.sessions;
+        sessionsNextCursor = page.next_cursor;
+        renderSessionList(loadedSessions);
     } catch (error) {
         console.error('加载会话列表失败:', error);
     }
@@ -266,11 +344,11 @@ function renderSessionList(sessions) {
             <div class="session-item ${session.id === currentSessionId ? 'active' : ''}" 
                  onclick="switchSession('${session.id}')">
                 <div class="session-title">${session.title}</div>
-                <div class="session-info">${modeText} · ${dateStr}</div>
+                <div class="session-info">${modeText} · ${session.message_count}条消息 · ${dateStr}</div>
                 <button class="session-delete" onclick="deleteSession(event, '${session.id}')">×</button>
             </div>
         `;
-    }).join('');
+    }).join('') + (sessionsNextCursor ? '<div class="session-item session-more" onclick="loadSessions(true)">加载更多</div>' : '');
 }
 
 async function createNewSession() {
@@ -294,10 +372,33 @@ async function createNewSession() {
     document.getElementById('dataAnalysisBtn').classList.remove('active');
 }
 
-async function switchSession(sessionId) {
-    try {
+async function fetchSessionDetail(sessionId) {
+    const cached = sessionDetailCache[sessionId];
+    if (!cached) {
         const response = await fetch(`/api/sessions/${sessionId}`);
         const session = await response.json();
+        if (!response.ok) throw new Error(session.error);
+        sessionDetailCache[sessionId] = { etag: response.headers.get('ETag'), session };
+        return session;
+    }
+
+    // 会话未变化时返回 304，变化时只返回已缓存消息之后的新消息
+    const response = await fetch(`/api/sessions/${sessionId}?since=${cached.session.messages.length}`, {
+        headers: cached.etag ? { 'If-None-Match': cached.etag } : {}
+    });
+    if (response.status === 304) return cached.session;
+    const delta = await response.json();
+    if (!response.ok) throw new Error(delta.error);
+    const messages = cached.session.messages.slice(0, delta.since).concat(delta.messages);
+    const session = { ...delta, messages };
+    delete session.since;
+    sessionDetailCache[sessionId] = { etag: response.headers.get('ETag'), session };
+    return session;
+}
+
+async function switchSession(sessionId) {
+    try {
+        const session = await fetchSessionDetail(sessionId);
         currentSessionId = sessionId;
         currentMode = session.mode;
         
@@ -336,6 +437,7 @@ async function deleteSession(event, sessionId) {
         const response = await fetch(`/api/sessions/${sessionId}`, { method: 'DELETE' });
         
         if (response.ok) {
+            delete sessionDetailCache[sessionId];
             if (sessionId === currentSessionId) {
                 currentSessionId = null;
                 clearChat();
@@ -451,6 +553,71 @@ async function clearKnowledge() {
     }
 }
 
+// 分片上传相关函数
+// 超过该大小的文件使用分片上传（服务器单次请求上限为16MB）
+const CHUNKED_UPLOAD_THRESHOLD = 15 * 1024 * 1024;
+
+async function sha256Hex(buffer) {
+    // crypto.subtle 仅在 HTTPS 或 localhost 下可用，不可用时不发送分片校验值
+    if (!window.crypto || !window.crypto.subtle) return null;
+    const hash = await window.crypto.subtle.digest('SHA-256', buffer);
+    return Array.from(new Uint8Array(hash)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// 分片上传文件并返回 upload_id，分片失败时查询服务器已接收的字节数后从断点重试
+async function uploadInChunks(file, onProgress) {
+    const initResponse = await fetch('/api/chunked_uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    let upload = await initResponse.json();
+    if (!initResponse.ok) throw new Error(upload.error);
+
+    let retries = 0;
+    while (upload.received < upload.size) {
+        const buffer = await file.slice(upload.received, upload.received + upload.chunk_size).arrayBuffer();
+        const headers = { 'Content-Type': 'application/octet-stream' };
+        const checksum = await sha256Hex(buffer);
+        if (checksum) headers['X-Chunk-SHA256'] = checksum;
+        try {
+            const response = await fetch(`/api/chunked_uploads/${upload.upload_id}?offset=${upload.received}`, {
+                method: 'PUT',
+                headers: headers,
+                body: buffer
+            });
+            const data = await response.json();
+            if (!response.ok && response.status !== 409) throw new Error(data.error);
+            if (response.ok) {
+                upload = data;
+                retries = 0;
+                if (onProgress) onProgress(upload.received / upload.size);
+                continue;
+            }
+        } catch (err) {
+            if (++retries > 3) throw err;
+            await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+        }
+        // 偏移量不一致或请求失败：以服务器记录的进度为准继续
+        const statusResponse = await fetch(`/api/chunked_uploads/${upload.upload_id}`);
+        if (statusResponse.ok) upload = await statusResponse.json();
+    }
+
+    const completeResponse = await fetch(`/api/chunked_uploads/${upload.upload_id}/complete`, { method: 'POST' });
+    const completed = await completeResponse.json();
+    if (!completeResponse.ok) throw new Error(completed.error);
+    return upload.upload_id;
+}
+
+// 把文件加入上传表单：大文件先分片上传，再以 upload_id 引用
+async function appendUploadFile(formData, file, onProgress) {
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+        formData.append('upload_id', await uploadInChunks(file, onProgress));
+    } else {
+        formData.append('file', file);
+    }
+}
+
 // 通知函数
 function showNotification(message, type = 'info') {
     const notification = document.createElement('div');
@@ -555,9 +722,11 @@ function setupExcelToolEvents() {
         processExcelBtn.innerHTML = '<span class="btn-loading"></span> 处理中...';
 
         const formData = new FormData();
-        formData.append('file', file);
 
         try {
+            await appendUploadFile(formData, file, ratio => {
+                processExcelBtn.innerHTML = `<span class="btn-loading"></span> 上传中 ${Math.round(ratio * 100)}%`;
+            });
             const response = await fetch('/api/process_excel', { method: 'POST', body: formData });
             const data = await response.json();
 
@@ -823,16 +992,37 @@ function setupDataAnalysisEvents() {
             startAnalysisBtn.innerHTML = '<span class="btn-loading"></span> 分析中...';
             
             const formData = new FormData();
-            formData.append('file', file);
             
             try {
-                const response = await fetch('/api/data_analysis', { method: 'POST', body: formData });
+                await appendUploadFile(formData, file, ratio => {
+                    startAnalysisBtn.innerHTML = `<span class="btn-loading"></span> 上传中 ${Math.round(ratio * 100)}%`;
+                });
+                // 提交后台分析任务，轮询阶段进度，完成后获取结果
+                const submitResponse = await fetch('/api/data_analysis/jobs', { method: 'POST', body: formData });
+                const job = await submitResponse.json();
+                if (!submitResponse.ok) {
+                    showNotification(`错误: ${job.error}`, 'error');
+                    console.error('数据分析错误:', job);
+                    return;
+                }
+                
+                let status = job;
+                while (status.status === 'queued' || status.status === 'running') {
+                    await new Promise(resolve => setTimeout(resolve, 1500));
+                    const statusResponse = await fetch(`/api/data_analysis/jobs/${job.job_id}`);
+                    status = await statusResponse.json();
+                    if (!statusResponse.ok) break;
+                    const stageText = status.status === 'queued' ? '排队中' : (status.stage || '分析中');
+                    startAnalysisBtn.innerHTML = `<span class="btn-loading"></span> ${stageText}...`;
+                }
+                
+                const response = await fetch(`/api/data_analysis/jobs/${job.job_id}/result`);
                 const data = await response.json();
                 
-                if (response.ok) {
+                if (response.status === 200) {
                     displayAnalysisResults(data);
                 } else {
-                    showNotification(`错误: ${data.error}`, 'error');
+                    showNotification(`错误: ${data.error || '分析任务未完成'}`, 'error');
                     console.error('数据分析错误:', data);
                 }
             } catch (err) {
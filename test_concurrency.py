@@ -0,0 +1,183 @@
+"""会话存储并发压测
+
+多线程同时对少量会话发起对话（普通和流式接口交替），大模型由 mock_dashscope.py 在本进程内模拟，
+检查没有丢失或交错的消息：每个会话的消息数等于成功的轮次数 x 2，用户消息和回复严格交替且一一对应，
+且每一轮构造提示词时都看到了之前所有轮次的历史（同一会话的轮次依次执行）。
+同时检查存储层的并发追加和临时会话设置的迁移只发生一次。
+
+用法：
+python test_concurrency.py [memory|sqlite] [线程数] [每线程轮次]
+"""
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+import mock_dashscope
+
+failures = []
+
+
+def check(condition, message):
+    print(("通过: " if condition else "失败: ") + message)
+    if not condition:
+        failures.append(message)
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    store_kind = sys.argv[1] if len(sys.argv) > 1 else 'memory'
+    thread_count = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    turn_count = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    session_count = 4
+    reply_prefix = '（模拟回复）已收到你的消息：'
+
+    # 启动本进程内的模拟大模型服务，不输出每个请求的日志
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    mock_server = make_server('127.0.0.1', 0, mock_dashscope.create_app({
+        'latency_mean': 0.02,
+        'latency_jitter': 0.01,
+        'stream_chunk_delay': 0,
+        'seed': 1
+    }), threaded=True)
+    threading.Thread(target=mock_server.serve_forever, daemon=True).start()
+
+    work_dir = tempfile.mkdtemp(prefix='session_stress_')
+    os.environ['API_URL'] = f"http://127.0.0.1:{mock_server.server_port}{mock_dashscope.GENERATION_PATH}"
+    os.environ['SESSION_STORE'] = store_kind
+    os.environ['SESSION_DB_PATH'] = os.path.join(work_dir, 'sessions.db')
+    os.environ['LLM_CACHE_ENDPOINTS'] = ''
+    # 不裁剪历史，便于从 prompt_report 得知每轮看到的历史消息数
+    os.environ['CHAT_HISTORY_MAX_MESSAGES'] = '100000'
+    os.environ['CHAT_PROMPT_TOKEN_BUDGET'] = '10000000'
+
+    import app as app_module
+    from session_store import MemorySessionStore, SQLiteSessionStore
+
+    # 1. 存储层：多线程向同一批会话追加消息
+    print(f"\n=== 存储层并发追加 ({thread_count}线程 x {turn_count}次) ===")
+    for store in (MemorySessionStore(), SQLiteSessionStore(os.path.join(work_dir, 'store.db'))):
+        name = type(store).__name__
+        ids = [f"store-{i}" for i in range(session_count)]
+        for session_id in ids:
+            store.create_session({'id': session_id, 'mode': 'normal', 'title': '新对话',
+                                  'created_at': '', 'updated_at': ''})
+
+        def append(worker):
+            for turn in range(turn_count):
+                session_id = ids[(worker + turn) % session_count]
+                store.append_messages(session_id, [
+                    {'role': 'user', 'content': f"{worker}-{turn}", 'timestamp': ''},
+                    {'role': 'assistant', 'content': f"{worker}-{turn}", 'timestamp': ''}
+                ], f"{time.time():.6f}")
+
+        run_threads(append, thread_count)
+        total = sum(store.get_session(session_id)['message_count'] for session_id in ids)
+        check(total == thread_count * turn_count * 2, f"{name} 消息总数 {total} == {thread_count * turn_count * 2}")
+        paired = all(
+            messages[i]['content'] == messages[i + 1]['content']
+            for messages in (store.get_session(session_id)['messages'] for session_id in ids)
+            for i in range(0, len(messages), 2)
+        )
+        check(paired, f"{name} 同一次追加的两条消息相邻")
+
+    # 2. 接口层：多线程同时在同一批会话中对话
+    print(f"\n=== 对话接口并发 ({store_kind}，{thread_count}线程 x {turn_count}轮，{session_count}个会话) ===")
+    client = app_module.app.test_client()
+    session_ids = []
+    for i in range(session_count):
+        response = client.post('/api/chat', json={'message': f"开场-{i}", 'session_id': 'new'})
+        session_ids.append(response.get_json()['session_id'])
+    succeeded = {session_id: 1 for session_id in session_ids}
+    history_seen = {session_id: [] for session_id in session_ids}
+    counter_lock = threading.Lock()
+    errors = []
+
+    def chat(worker):
+        local_client = app_module.app.test_client()
+        for turn in range(turn_count):
+            session_id = session_ids[(worker + turn) % session_count]
+            message = f"线程{worker}-第{turn}轮"
+            if turn % 2:
+                response = local_client.post('/api/chat/stream', json={
+                    'message': message,
+                    'session_id': session_id
+                })
+                body = response.get_data(as_text=True)
+                ok = response.status_code == 200 and 'event: done' in body
+                if ok:
+                    session_event = body.split('event: session\ndata: ', 1)[1].split('\n', 1)[0]
+                    report = json.loads(session_event)['prompt_report']
+            else:
+                response = local_client.post('/api/chat', json={'message': message, 'session_id': session_id})
+                ok = response.status_code == 200
+                if ok:
+                    report = response.get_json()['prompt_report']
+            with counter_lock:
+                if ok:
+                    succeeded[session_id] += 1
+                    history_seen[session_id].append(report['history_kept'] + report['history_dropped'])
+                else:
+                    errors.append(response.status_code)
+
+    started = time.time()
+    run_threads(chat, thread_count)
+    elapsed = time.time() - started
+    print(f"耗时 {elapsed:.2f}s，{thread_count * turn_count / elapsed:.1f} 轮/秒，失败 {len(errors)} 轮 {errors[:5]}")
+
+    for session_id in session_ids:
+        session = client.get(f"/api/sessions/{session_id}").get_json()
+        messages = session['messages']
+        check(len(messages) == succeeded[session_id] * 2,
+              f"会话 {session_id[:8]} 消息数 {len(messages)} == 成功轮次 {succeeded[session_id]} x 2")
+        alternating = all(
+            message['role'] == ('user' if i % 2 == 0 else 'assistant') for i, message in enumerate(messages)
+        )
+        matched = all(
+            messages[i + 1]['content'].startswith(reply_prefix + messages[i]['content'])
+            for i in range(0, len(messages) - 1, 2)
+        )
+        check(alternating and matched, f"会话 {session_id[:8]} 用户消息和回复严格交替且一一对应")
+        check(session['title'].startswith('开场-'), f"会话 {session_id[:8]} 标题来自第一条消息")
+        # 依次执行时第 k 轮看到 2k 条历史；并发读到同一份历史时会出现重复的值
+        expected = list(range(2, succeeded[session_id] * 2, 2))
+        check(sorted(history_seen[session_id]) == expected, f"会话 {session_id[:8]} 每轮都看到之前全部轮次的历史")
+
+    # 3. 临时会话的 prompt 只迁移到一个新会话
+    print("\n=== 临时会话设置迁移 ===")
+    client.post('/api/set_prompt', json={'session_id': 'temp', 'prompt': '请简短回答'})
+    new_ids = []
+
+    def new_chat(worker):
+        response = app_module.app.test_client().post('/api/chat', json={
+            'message': f"新会话{worker}",
+            'session_id': 'new'
+        })
+        with counter_lock:
+            new_ids.append(response.get_json()['session_id'])
+
+    run_threads(new_chat, thread_count)
+    with_prompt = [session_id for session_id in new_ids if app_module.session_store.get_prompt(session_id)]
+    check(len(with_prompt) == 1, f"{len(new_ids)} 个并发新会话中恰好 1 个获得临时 prompt（实际 {len(with_prompt)}）")
+    check(app_module.session_store.get_prompt('temp') is None, "临时 prompt 已迁移")
+    check(app_module.session_locks.stats() == {'held': 0, 'waiting': 0}, "所有会话锁均已释放")
+
+    mock_server.shutdown()
+    print("\n全部通过" if not failures else f"\n{len(failures)} 项失败")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
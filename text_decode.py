@@ -0,0 +1,133 @@
+"""文本文件的流式解码
+
+用 chardet 的增量检测器 UniversalDetector 判断编码，检测和解码都直接读取内存映射的文件，
+不会把整个文件读入内存，也不会因为编码猜错而从磁盘反复重读。
+每个候选编码先从头到尾严格解码一遍（不保留结果），中途失败时从映射的开头换下一个候选编码；
+全部候选编码都失败时才把无法解码的字节替换为 U+FFFD，并在 stats 中报告替换的字符数。
+解码结果统一为 Python 字符串（写入缓存时即为 UTF-8），换行统一为 \\n。
+
+只有检测和解码过程的内存占用与文件大小无关：read_text_file 返回完整的字符串，
+入库时检索索引、文档文本缓存和会话存储也都保存完整文本，整体内存占用仍随文件大小增长。
+"""
+import codecs
+import mmap
+import os
+
+from chardet.universaldetector import UniversalDetector
+
+# 编码检测最多读取的字节数，以及解码时每块的大小
+DETECT_MAX_BYTES = 1024 * 1024
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+# 检测结果为子集编码时改用其超集，避免文件后半部分出现检测范围外的字符时解码失败
+ENCODING_SUPERSETS = {
+    'ascii': 'utf-8',
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030'
+}
+
+# 检测结果不可靠时依次尝试的编码
+FALLBACK_ENCODINGS = ['utf-8', 'gb18030', 'big5', 'utf-16']
+
+# 替换为 U+FFFD 的字符超过这个比例时视为编码无法识别，不再入库
+MAX_REPLACED_RATIO = 0.01
+
+
+class UndecodableTextError(Exception):
+    """没有可用的候选编码"""
+
+
+def detect_encoding(data, max_bytes=DETECT_MAX_BYTES, chunk_size=64 * 1024):
+    """用增量检测器检测编码，检测器有把握后立即停止，返回 (编码, 置信度)"""
+    detector = UniversalDetector()
+    limit = min(len(data), max_bytes)
+    for start in range(0, limit, chunk_size):
+        detector.feed(data[start:min(start + chunk_size, limit)])
+        if detector.done:
+            break
+    detector.close()
+    result = detector.result
+    return result.get('encoding'), result.get('confidence') or 0.0
+
+
+def candidate_encodings(detected, confidence, min_confidence=0.5):
+    """按优先级排列的候选编码"""
+    candidates = []
+    if detected and confidence >= min_confidence:
+        detected = detected.lower()
+        candidates.append(ENCODING_SUPERSETS.get(detected, detected))
+    for encoding in FALLBACK_ENCODINGS:
+        if encoding not in candidates:
+            candidates.append(encoding)
+    return candidates
+
+
+def _iter_decode(data, encoding, chunk_size, errors='strict'):
+    """按块增量解码并统一换行，严格模式下无法解码时抛出 UnicodeDecodeError"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    pending_cr = False
+    total = len(data)
+    for start in range(0, total, chunk_size):
+        chunk = data[start:start + chunk_size]
+        final = start + chunk_size >= total
+        text = decoder.decode(chunk, final)
+        if pending_cr:
+            text = '\r' + text
+        # 块末尾的 \r 可能与下一块开头的 \n 组成 \r\n，留到下一块再处理
+        pending_cr = text.endswith('\r') and not final
+        if pending_cr:
+            text = text[:-1]
+        yield text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _decodes(data, encoding, chunk_size):
+    """整个文件能否用该编码严格解码；None 表示 Python 不支持该编码名"""
+    try:
+        for _ in _iter_decode(data, encoding, chunk_size):
+            pass
+    except UnicodeDecodeError:
+        return False
+    except LookupError:
+        # chardet 返回了 Python 不支持的编码名
+        return None
+    return True
+
+
+def iter_text_file(filepath, chunk_size=DECODE_CHUNK_SIZE, stats=None):
+    """逐块产出解码后的文本
+
+    stats 字典会被填入 encoding、confidence、bytes、replaced_chars（替换为 U+FFFD 的字符数，
+    只在所有候选编码都无法完整解码时大于 0）。
+    """
+    stats = stats if stats is not None else {}
+    stats.update({'encoding': None, 'confidence': 0.0, 'bytes': 0, 'replaced_chars': 0})
+    size = os.path.getsize(filepath)
+    stats['bytes'] = size
+    if size == 0:
+        return
+
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        detected, confidence = detect_encoding(data)
+        stats['confidence'] = confidence
+        supported = []
+        for encoding in candidate_encodings(detected, confidence):
+            result = _decodes(data, encoding, chunk_size)
+            if result is None:
+                continue
+            supported.append(encoding)
+            if result:
+                stats['encoding'] = encoding
+                yield from _iter_decode(data, encoding, chunk_size)
+                return
+        if not supported:
+            raise UndecodableTextError('无法读取文件内容：编码格式不支持')
+        # 没有编码能完整解码时用优先级最高的编码，无法解码的字节替换为 U+FFFD
+        stats['encoding'] = supported[0]
+        for text in _iter_decode(data, supported[0], chunk_size, errors='replace'):
+            stats['replaced_chars'] += text.count('\ufffd')
+            yield text
+
+
+def read_text_file(filepath, chunk_size=DECODE_CHUNK_SIZE, stats=None):
+    """读取整个文本文件，返回解码后的完整字符串（占用与文件文本大小相当的内存）"""
+    return ''.join(iter_text_file(filepath, chunk_size, stats))